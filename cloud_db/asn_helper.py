@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+from common import metrics
 from delaymsg import DelayMsg
 from netaddr import IPAddress, IPRange
 from urllib.request import urlopen, Request
@@ -8,13 +9,14 @@ import os
 
 def download(url, fn, desc=None):
     print(f"Downloading '{fn if desc is None else desc}'...")
-    with open(fn, "wb") as f:
+    with metrics.span("asn.download"), open(fn, "wb") as f:
         req = Request(url, headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/132.0.0.0 Safari/537.36"})
         resp = urlopen(req)
         while True:
             bits = resp.read(131072)
             if len(bits) == 0:
                 break
+            metrics.count("http.bytes", len(bits), key="ip2asn")
             f.write(bits)
 
 def get_data():
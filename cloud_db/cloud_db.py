@@ -10,12 +10,12 @@
 #   https://cloud-ips.s3-us-west-2.amazonaws.com/index.html
 
 from collections import deque
+from bisect import bisect_right
 from datetime import datetime
-from netaddr import IPNetwork
-import gzip
 import json
 import os
 import socket
+import sqlite3
 import struct
 import itertools
 import sys
@@ -23,8 +23,13 @@ if sys.version_info >= (3, 11): from datetime import UTC
 else: import datetime as datetime_fix; UTC=datetime_fix.timezone.utc
 
 BASE_DIR = os.path.split(__file__)[0]
+sys.path.insert(0, os.path.join(BASE_DIR, "..", "helpers"))
+from common import codec, metrics, profiling
 COOKIE = b'Cloud IPs Database\n\x00\x00'
+MEMBERS_COOKIE = b'Cloud IPs Members\n\x00\x00\x00'
 RANGES_ONLY = False
+# When set to a list, add_data collects the raw ranges here instead of building the tree
+EXPORT_ROWS = None
 
 class Level:
     # The basic idea here is to store a series of pages.  Each page
@@ -47,7 +52,13 @@ def add_data(source, targets, prefix, service, region):
         print(prefix)
         return
 
-    # First off, pick the IPv4 or IPv6 tree
+    if EXPORT_ROWS is not None:
+        EXPORT_ROWS.append((source, service, region, prefix))
+        return
+
+    # First off, pick the IPv4 or IPv6 tree, netaddr is only loaded when
+    # building, lookups don't need it
+    from netaddr import IPNetwork
     cidr = IPNetwork(prefix)
     if cidr.ip.version == 4:
         level = targets.zero
@@ -98,11 +109,17 @@ def enum_pages(targets):
             todo.appendleft(page.zero)
             todo.appendleft(page.one)
 
+def load_data_file(name):
+    # Load one of the JSON data files, with whatever codec it was compressed with
+    fn = codec.find_file(os.path.join(BASE_DIR, "..", "data", name))
+    if fn is None:
+        raise Exception(f"Unable to find data file for {name}")
+    return json.loads(codec.read_file(fn))
+
 def add_github(stats, targets, sources, short_name, long_name):
     # Add all GitHub ranges to our current working set
     sources[short_name] = long_name
-    with gzip.open(os.path.join(BASE_DIR, "..", "data", "raw_github.json.gz")) as f:
-        data = json.load(f)
+    data = load_data_file("raw_github.json")
 
     stats["sources"] += 1
     for key, value in data.items():
@@ -114,8 +131,7 @@ def add_github(stats, targets, sources, short_name, long_name):
 def add_aws(stats, targets, sources, short_name, long_name):
     # Add all AWS ranges to our current working set
     sources[short_name] = long_name
-    with gzip.open(os.path.join(BASE_DIR, "..", "data", "raw_aws.json.gz")) as f:
-        data = json.load(f)
+    data = load_data_file("raw_aws.json")
 
     stats["sources"] += 1
     for cur in data["prefixes"] + data["ipv6_prefixes"]:
@@ -126,8 +142,7 @@ def add_aws(stats, targets, sources, short_name, long_name):
 def add_google(stats, targets, sources, short_name, long_name):
     # Add all Google ranges to our current working set
     sources[short_name] = long_name
-    with gzip.open(os.path.join(BASE_DIR, "..", "data", "raw_google.json.gz")) as f:
-        data = json.load(f)
+    data = load_data_file("raw_google.json")
 
     stats["sources"] += 1
     for cur in data['prefixes']:
@@ -138,8 +153,7 @@ def add_google(stats, targets, sources, short_name, long_name):
 def add_azure(stats, targets, sources, short_name, long_name):
     # Add all Azure ranges to our current working set
     sources[short_name] = long_name
-    with gzip.open(os.path.join(BASE_DIR, "..", "data", "raw_azure.json.gz")) as f:
-        data = json.load(f)
+    data = load_data_file("raw_azure.json")
 
     stats["sources"] += 1
     for group in data["values"]:
@@ -210,15 +224,14 @@ def add_private(stats, targets, sources, short_name, long_name):
 
 def add_other(stats, targets, source):
     # Add IPs from a pre-parsed list of data
-    with gzip.open(os.path.join(BASE_DIR, "..", "data", f"data_{source}.json.gz")) as f:
-        data = json.load(f)
+    data = load_data_file(f"data_{source}.json")
 
     stats["sources"] += 1
     for prefix in data['v4'] + data['v6']:
         stats["ranges"] += 1
         add_data(source, targets, prefix, "", "")
 
-def create_db(target_file):
+def create_db(target_file, json_leaves=False):
     # The main page includes sub pages for IPv4 and IPv6
     targets = Level(both=None, zero=Level(), one=Level(), offset=0)
 
@@ -243,23 +256,30 @@ def create_db(target_file):
     }
     for source in sources:
         show_info(f"Adding {source}")
-        add_other(stats, targets, source)
+        with metrics.span("cloud_db.add", source=source):
+            add_other(stats, targets, source)
     # Each of these helpers will add the description to the sources dictionary
     show_info(f"Adding AWS")
-    add_aws(stats, targets, sources, "aws", "AWS")
+    with metrics.span("cloud_db.add", source="aws"):
+        add_aws(stats, targets, sources, "aws", "AWS")
     show_info(f"Adding Google")
-    add_google(stats, targets, sources, "google", "Google")
+    with metrics.span("cloud_db.add", source="google"):
+        add_google(stats, targets, sources, "google", "Google")
     show_info(f"Adding Azure")
-    add_azure(stats, targets, sources, "azure", "Azure")
+    with metrics.span("cloud_db.add", source="azure"):
+        add_azure(stats, targets, sources, "azure", "Azure")
     show_info(f"Adding GitHub")
-    add_github(stats, targets, sources, "github", "GitHub")
+    with metrics.span("cloud_db.add", source="github"):
+        add_github(stats, targets, sources, "github", "GitHub")
     show_info(f"Adding Private IPs")
-    add_private(stats, targets, sources, "private", "Private IP")
+    with metrics.span("cloud_db.add", source="private"):
+        add_private(stats, targets, sources, "private", "Private IP")
 
-    add_asn(stats, targets, sources)
+    with metrics.span("cloud_db.add", source="asn"):
+        add_asn(stats, targets, sources)
 
-    if RANGES_ONLY:
-        return
+    if RANGES_ONLY or EXPORT_ROWS is not None:
+        return sources
 
     show_info(f"Writing out final data")
     # Helper to encode a value to a byte string
@@ -285,8 +305,26 @@ def create_db(target_file):
             ret += value
         return ret
 
+    # Helper to render a data blob to the final JSON a lookup would return
+    def render_json(value):
+        ret = []
+        for source, service, region, prefix in value:
+            item_dict = {"source": sources.get(source, source)}
+            if len(service) > 0:
+                item_dict['service'] = service
+            if len(region) > 0:
+                item_dict['region'] = region
+            if len(prefix) > 0:
+                item_dict['prefix'] = prefix
+            ret.append(item_dict)
+        return json.dumps(ret).encode("utf-8")
+
     # Figure out all of the page offsets
     valid_pages = {}
+    # If requested, each data page is preceded by its JSON rendering, and 
+    # the length of that rendering, so a reader can go straight from the 
+    # data page's offset to the bytes to send back
+    json_pages = {}
     offset = 128
     field_size = 4
     for page in enum_pages(targets):
@@ -296,12 +334,18 @@ def create_db(target_file):
             stats["branches"] += 1
         else:
             key = encode_data(page.both)
+            if json_leaves and key not in json_pages:
+                rendered = render_json(page.both)
+                json_pages[key] = rendered + struct.pack("!I", len(rendered))
             page.both = key
             valid_pages[key] = 0
 
-    # Add some stats, including the size of the file minus the final page
+    # Add some stats, including the size of the file minus the final page,
+    # along with any pre-rendered JSON and its lengths
     stats["leafs"] = len(valid_pages)
-    stats["size"] = offset + sum(len(x) for x in valid_pages)
+    if json_leaves:
+        stats["json_size"] = sum(len(x) for x in json_pages.values())
+    stats["size"] = offset + sum(len(x) for x in valid_pages) + stats.get("json_size", 0)
 
     # Add one final page with some information
     info_page = encode_data({
@@ -313,6 +357,7 @@ def create_db(target_file):
 
     # Store the offsets for the data pages
     for key in valid_pages:
+        offset += len(json_pages.get(key, b''))
         valid_pages[key] = offset
         offset += len(key)
 
@@ -322,7 +367,7 @@ def create_db(target_file):
     # Write out all of the data
     with open(target_file, "wb") as f:
         header = COOKIE
-        header += struct.pack("!HHQ", 2, field_size, valid_pages[info_page])
+        header += struct.pack("!HHQB", 2, field_size, valid_pages[info_page], 1 if json_leaves else 0)
         header += b'\x00' * (128 - len(header))
         f.write(header)
 
@@ -344,14 +389,326 @@ def create_db(target_file):
         valid_pages = [(k, v) for k, v in valid_pages.items()]
         valid_pages.sort(key=lambda x: x[1])
         for key, target_offset in valid_pages:
+            if key in json_pages:
+                f.write(json_pages[key])
+                offset += len(json_pages[key])
             if offset != target_offset:
                 raise Exception("Incorrect offset for page!")
             # Data pages are two bytes for the length, followed by the data
             f.write(key)
             offset += len(key)
 
-def lookup_ip(db_file, ip):
-    # Lookup an IP
+def gather_ranges():
+    # Run through all of the sources, and just return the ranges they
+    # add, rather than building the tree
+    global EXPORT_ROWS
+    EXPORT_ROWS = []
+    try:
+        sources = create_db(None)
+        rows = EXPORT_ROWS
+    finally:
+        EXPORT_ROWS = None
+
+    # Turn each prefix into an integer range
+    from netaddr import IPNetwork
+    ret = []
+    for source, service, region, prefix in rows:
+        cidr = IPNetwork(prefix)
+        ret.append((cidr.version, cidr.first, cidr.last, cidr.prefixlen, source, service, region, prefix))
+    return sources, ret
+
+# SQLite only stores signed 64-bit integers, so each 64-bit half of an
+# address is stored with this bias subtracted, which keeps the sort order
+SQLITE_BIAS = 2 ** 63
+
+def sqlite_key(value):
+    # Split an integer IP into the high and low columns used by the SQLite export
+    return (value >> 64) - SQLITE_BIAS, (value & 0xffffffffffffffff) - SQLITE_BIAS
+
+def export_sqlite(target_file):
+    # Write every range out to a SQLite database, one row per range
+    sources, rows = gather_ranges()
+
+    show_info(f"Writing out {len(rows):,} ranges")
+    if os.path.isfile(target_file):
+        os.unlink(target_file)
+    db = sqlite3.connect(target_file)
+    db.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)")
+    db.execute("CREATE TABLE sources (source TEXT PRIMARY KEY, name TEXT)")
+    db.execute("""
+        CREATE TABLE ranges (
+            version INTEGER, 
+            start_hi INTEGER, start_lo INTEGER, 
+            end_hi INTEGER, end_lo INTEGER, 
+            prefix_len INTEGER, 
+            source TEXT, service TEXT, region TEXT, prefix TEXT
+        )
+    """)
+    db.execute("INSERT INTO info VALUES (?, ?)", ("built", datetime.now(UTC).replace(tzinfo=None).strftime("%Y-%m-%d %H:%M:%S")))
+    db.execute("INSERT INTO info VALUES (?, ?)", ("bias", str(SQLITE_BIAS)))
+    db.executemany("INSERT INTO sources VALUES (?, ?)", sources.items())
+
+    def enum_rows():
+        for version, first, last, prefix_len, source, service, region, prefix in rows:
+            # Store the network address, in case the prefix has host bits set
+            yield (version,) + sqlite_key(first) + sqlite_key(last) + (prefix_len, source, service, region, prefix)
+    db.executemany("INSERT INTO ranges VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", enum_rows())
+
+    # Since ranges can nest, a point lookup is done by probing each prefix length
+    # for an exact match of the masked address, the first index makes each probe a 
+    # single seek.  The second serves "start <= ip AND end >= ip" style joins.
+    show_info("Creating indexes")
+    db.execute("CREATE INDEX ranges_lookup ON ranges (version, prefix_len, start_hi, start_lo)")
+    db.execute("CREATE INDEX ranges_start ON ranges (version, start_hi, start_lo)")
+    db.commit()
+    db.execute("VACUUM")
+    db.close()
+
+def lookup_sqlite(db_file, ip):
+    # Lookup an IP in a SQLite export, returns the same format as lookup_ip
+    ipv6 = ":" in ip
+    version, bits = (6, 128) if ipv6 else (4, 32)
+    value = int.from_bytes(socket.inet_pton(socket.AF_INET6 if ipv6 else socket.AF_INET, ip), "big")
+
+    db = sqlite3.connect(db_file) if isinstance(db_file, str) else db_file
+    try:
+        sources = dict(db.execute("SELECT source, name FROM sources"))
+        lengths = [x[0] for x in db.execute("SELECT DISTINCT prefix_len FROM ranges WHERE version = ?", (version,))]
+        ret = []
+        for prefix_len in sorted(lengths):
+            start_hi, start_lo = sqlite_key((value >> (bits - prefix_len)) << (bits - prefix_len))
+            for source, service, region, prefix in db.execute(
+                "SELECT source, service, region, prefix FROM ranges "
+                "WHERE version = ? AND prefix_len = ? AND start_hi = ? AND start_lo = ?", 
+                (version, prefix_len, start_hi, start_lo),
+            ):
+                item_dict = {"source": sources.get(source, source)}
+                if len(service) > 0:
+                    item_dict['service'] = service
+                if len(region) > 0:
+                    item_dict['region'] = region
+                if len(prefix) > 0:
+                    item_dict['prefix'] = prefix
+                ret.append(item_dict)
+        return ret
+    finally:
+        if isinstance(db_file, str):
+            db.close()
+
+def write_npy(fn, dtype, fmt, values):
+    # Write a single column out in NumPy's .npy format, this is simple
+    # enough that we don't need NumPy itself to produce it
+    header = repr({'descr': dtype, 'fortran_order': False, 'shape': (len(values),)})
+    # The header is padded so the data starts on a 64 byte boundary
+    header += " " * (64 - ((10 + len(header) + 1) % 64)) + "\n"
+    with open(fn, "wb") as f:
+        f.write(b'\x93NUMPY\x01\x00' + struct.pack("<H", len(header)) + header.encode("latin1"))
+        for i in range(0, len(values), 65536):
+            chunk = values[i:i+65536]
+            f.write(struct.pack(f"<{len(chunk)}{fmt}", *chunk))
+
+def export_columnar(target_dir):
+    # Write every range out as a set of columns, using Parquet if pyarrow is
+    # available, or one .npy file per column if it's not
+    sources, rows = gather_ranges()
+
+    # IPv6 addresses don't fit in any common integer type, so split each
+    # address into a high and low 64-bit column
+    columns = {
+        "version": [x[0] for x in rows],
+        "start_hi": [x[1] >> 64 for x in rows],
+        "start_lo": [x[1] & 0xffffffffffffffff for x in rows],
+        "end_hi": [x[2] >> 64 for x in rows],
+        "end_lo": [x[2] & 0xffffffffffffffff for x in rows],
+        "prefix_len": [x[3] for x in rows],
+    }
+    # And the string columns are stored as categoricals
+    categories = {}
+    for col, name in [(4, "source"), (5, "service"), (6, "region")]:
+        values = sorted(set(x[col] for x in rows))
+        codes = {x: i for i, x in enumerate(values)}
+        if name == "source":
+            # Use the pretty name of the sources
+            values = [sources.get(x, x) for x in values]
+        categories[name] = values
+        columns[name] = [codes[x[col]] for x in rows]
+
+    if not os.path.isdir(target_dir):
+        os.mkdir(target_dir)
+
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        pyarrow = None
+
+    if pyarrow is not None:
+        fn = os.path.join(target_dir, "cloud_db.parquet")
+        show_info(f"Writing out {len(rows):,} ranges to {fn}")
+        table = {
+            "version": pyarrow.array(columns["version"], pyarrow.uint8()),
+            "start_hi": pyarrow.array(columns["start_hi"], pyarrow.uint64()),
+            "start_lo": pyarrow.array(columns["start_lo"], pyarrow.uint64()),
+            "end_hi": pyarrow.array(columns["end_hi"], pyarrow.uint64()),
+            "end_lo": pyarrow.array(columns["end_lo"], pyarrow.uint64()),
+            "prefix_len": pyarrow.array(columns["prefix_len"], pyarrow.uint8()),
+        }
+        for name, values in categories.items():
+            table[name] = pyarrow.DictionaryArray.from_arrays(
+                pyarrow.array(columns[name], pyarrow.int32()), 
+                pyarrow.array(values, pyarrow.string()),
+            )
+        pyarrow.parquet.write_table(pyarrow.table(table), fn)
+    else:
+        show_info(f"Writing out {len(rows):,} ranges to {target_dir}")
+        for name, dtype, fmt in [
+            ("version", "|u1", "B"),
+            ("start_hi", "<u8", "Q"),
+            ("start_lo", "<u8", "Q"),
+            ("end_hi", "<u8", "Q"),
+            ("end_lo", "<u8", "Q"),
+            ("prefix_len", "|u1", "B"),
+            ("source", "<i4", "i"),
+            ("service", "<i4", "i"),
+            ("region", "<i4", "i"),
+        ]:
+            write_npy(os.path.join(target_dir, f"{name}.npy"), dtype, fmt, columns[name])
+        # The categorical columns are codes into these lists
+        with open(os.path.join(target_dir, "categories.json"), "wt", newline="") as f:
+            json.dump(categories, f, separators=(',', ':'))
+
+def merge_ranges(ranges):
+    # Merge a list of (first, last) ranges into a sorted list of disjoint ranges
+    ret = []
+    for first, last in sorted(ranges):
+        if len(ret) > 0 and first <= ret[-1][1] + 1:
+            if last > ret[-1][1]:
+                ret[-1][1] = last
+        else:
+            ret.append([first, last])
+    return ret
+
+def export_members(target_file):
+    # Write out a membership file for each source, this answers "is this IP 
+    # part of source X" without walking the tree.  For IPv4, each source has
+    # a bitmap with one bit per /24 that's entirely in the source, along with an
+    # exact list for the /24s that are only partly in the source.  IPv6 is far
+    # too sparse for a bitmap, so it's just a sorted list of ranges.
+    sources, rows = gather_ranges()
+
+    per_source = {}
+    for version, first, last, _, source, _, _, _ in rows:
+        # ASN data covers nearly everything, so a membership test is useless for it
+        if source != "asn":
+            per_source.setdefault(source, {4: [], 6: []})[version].append((first, last))
+
+    show_info(f"Writing out membership for {len(per_source)} sources")
+    index = {"sources": {}, "built": datetime.now(UTC).replace(tzinfo=None).strftime("%Y-%m-%d %H:%M:%S")}
+    blobs = []
+    offset = 128
+    for source in sorted(per_source):
+        bits = bytearray(2 ** 24 // 8)
+        partial = []
+        for first, last in merge_ranges(per_source[source][4]):
+            # Find the /24s that are entirely inside of this range
+            block_first = (first + 255) >> 8
+            block_last = ((last + 1) >> 8) - 1
+            if block_first > block_last:
+                partial.append((first, last))
+                continue
+            if first < (block_first << 8):
+                partial.append((first, (block_first << 8) - 1))
+            if last > (block_last << 8) + 255:
+                partial.append(((block_last << 8) + 256, last))
+            # Set the bits one at a time at the edges, and a byte at a time in the middle
+            block = block_first
+            while block <= block_last:
+                if block % 8 == 0 and block + 7 <= block_last:
+                    count = (block_last + 1 - block) // 8
+                    bits[block // 8:block // 8 + count] = b'\xff' * count
+                    block += count * 8
+                else:
+                    bits[block // 8] |= 0x80 >> (block % 8)
+                    block += 1
+        v4_partial = b''.join(struct.pack("!II", first, last) for first, last in partial)
+        v6 = b''.join(
+            struct.pack("!QQQQ", first >> 64, first & 0xffffffffffffffff, last >> 64, last & 0xffffffffffffffff)
+            for first, last in merge_ranges(per_source[source][6])
+        )
+
+        index["sources"][source] = {
+            "name": sources.get(source, source),
+            "v4_bits": offset,
+            "v4_partial": [offset + len(bits), len(partial)],
+            "v6": [offset + len(bits) + len(v4_partial), len(v6) // 32],
+        }
+        blobs.extend([bits, v4_partial, v6])
+        offset += len(bits) + len(v4_partial) + len(v6)
+
+    with open(target_file, "wb") as f:
+        header = MEMBERS_COOKIE
+        header += struct.pack("!HQ", 1, offset)
+        header += b'\x00' * (128 - len(header))
+        f.write(header)
+        for blob in blobs:
+            f.write(blob)
+        f.write(json.dumps(index, separators=(',', ':'), sort_keys=True).encode("utf-8"))
+
+class MembershipDB:
+    # Answer "is this IP in source X" using the file from export_members
+    def __init__(self, fn):
+        import mmap
+        with open(fn, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MEMBERS_COOKIE)] != MEMBERS_COOKIE:
+            raise Exception("Not a membership file")
+        _, index_loc = struct.unpack_from("!HQ", self.data, len(MEMBERS_COOKIE))
+        index = json.loads(self.data[index_loc:].decode("utf-8"))
+        self.built = index["built"]
+
+        # The bitmaps are used in place, the exact lists are small enough to load
+        self.sources = {}
+        self.short_names = list(index["sources"])
+        for source, info in index["sources"].items():
+            v4 = [struct.unpack_from("!II", self.data, info["v4_partial"][0] + i * 8) for i in range(info["v4_partial"][1])]
+            v6 = []
+            for i in range(info["v6"][1]):
+                first_hi, first_lo, last_hi, last_lo = struct.unpack_from("!QQQQ", self.data, info["v6"][0] + i * 32)
+                v6.append(((first_hi << 64) | first_lo, (last_hi << 64) | last_lo))
+            entry = (info["v4_bits"], [x[0] for x in v4], [x[1] for x in v4], [x[0] for x in v6], [x[1] for x in v6])
+            # Allow both the short name and the pretty name to be used
+            self.sources[source] = entry
+            self.sources[info["name"]] = entry
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kargs):
+        self.close()
+
+    def close(self):
+        self.data.close()
+
+    def contains(self, source, ip):
+        if source not in self.sources:
+            raise ValueError(f"Unknown source '{source}', valid sources are: {', '.join(sorted(self.short_names))}")
+        bits, v4_first, v4_last, v6_first, v6_last = self.sources[source]
+        if ":" in ip:
+            value = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), "big")
+            starts, ends = v6_first, v6_last
+        else:
+            # A single bit test handles everything but the partial /24s
+            value = int.from_bytes(socket.inet_aton(ip), "big")
+            block = value >> 8
+            if self.data[bits + (block >> 3)] & (0x80 >> (block & 7)):
+                return True
+            starts, ends = v4_first, v4_last
+        i = bisect_right(starts, value) - 1
+        return i >= 0 and value <= ends[i]
+
+def lookup_ip(db_file, ip, raw_json=False):
+    # Lookup an IP, if raw_json is set, return the results as JSON bytes, using
+    # the pre-rendered JSON in the database if it has it
 
     # First off, see if it's IPv6
     ipv6 = ":" in ip
@@ -379,8 +736,9 @@ def lookup_ip(db_file, ip):
     with FileHelper() as f:
         # Seek past the header's cookie
         f.seek(21)
-        # Get the size of a field, and the location of the info dictionary
-        _, field_size, info_loc = struct.unpack("!HHQ", f.read(12))
+        # Get the size of a field, the location of the info dictionary, 
+        # and the flags to show if the data pages have pre-rendered JSON
+        _, field_size, info_loc, flags = struct.unpack("!HHQB", f.read(13))
 
         # Ok, we have the IP address as a list of bits, along with an extra
         # byte at the beggining.  We only care about the last bit from
@@ -401,6 +759,13 @@ def lookup_ip(db_file, ip):
                 # Read offset value for the given bit's value
                 offset = struct.unpack("!Q", b"\x00" * (8-field_size) + f.read(field_size))[0]
 
+        if raw_json and ip != "info" and (flags & 1) == 1:
+            # The JSON is stored just before the data page, followed by its length
+            f.seek(offset // 2 - 4)
+            size = struct.unpack("!I", f.read(4))[0]
+            f.seek(offset // 2 - 4 - size)
+            return f.read(size)
+
         def decode(f, offset):
             # Helper to decode a value, understands dicts, lists, and strings
             f.seek(offset)
@@ -457,6 +822,8 @@ def lookup_ip(db_file, ip):
             if len(item[3]) > 0:
                 item_dict['prefix'] = item[3]
             ret.append(item_dict)
+        if raw_json:
+            return json.dumps(ret).encode("utf-8")
         return ret
 
 def test_data(fn):
@@ -513,10 +880,17 @@ def lookup_ips(fn, ips):
 
 def main():
     global RANGES_ONLY
+    profiling.check_args(sys.argv)
     if len(sys.argv) == 1 or sys.argv[1] in {"--help", "-h", "/?", "/h"}:
         print("Usage:")
         print("  build - Rebuild the cloud_db.dat database file")
+        print("  build_json - Rebuild the database, including pre-rendered JSON results")
         print("  ranges - Output ranges used for database only")
+        print("  sqlite - Export all ranges to a SQLite database")
+        print("  columns - Export all ranges to Parquet, or .npy files without pyarrow")
+        print("  members - Build per-source membership file for quick checks")
+        print("  contains <source> <ip> - Check if IP is in source using membership file")
+        print("  --profile - Profile each step, along with any of the above, see helpers/common/profiling.py")
         print("  <ip> - Lookup IP and show results")
         exit(1)
 
@@ -524,14 +898,39 @@ def main():
     if sys.argv[1] == "ranges":
         RANGES_ONLY = True
         create_db(fn)
-    elif sys.argv[1] == "build":
+    elif sys.argv[1] == "sqlite":
+        show_info("Exporting to SQLite...")
+        with metrics.span("cloud_db.export", format="sqlite"), profiling.profile("sqlite"):
+            export_sqlite(os.path.join("data", "cloud_db.sqlite"))
+        show_info("All done")
+    elif sys.argv[1] == "columns":
+        show_info("Exporting columns...")
+        with metrics.span("cloud_db.export", format="columns"), profiling.profile("columns"):
+            export_columnar(os.path.join("data", "cloud_db_columns"))
+        show_info("All done")
+    elif sys.argv[1] == "members":
+        show_info("Building membership file...")
+        with metrics.span("cloud_db.export", format="members"), profiling.profile("members"):
+            export_members(os.path.join("data", "cloud_db_members.dat"))
+        show_info("All done")
+    elif sys.argv[1] == "contains" and len(sys.argv) == 4:
+        with MembershipDB(os.path.join("data", "cloud_db_members.dat")) as db:
+            try:
+                print(f" {sys.argv[3]} in {sys.argv[2]}: {db.contains(sys.argv[2], sys.argv[3])}")
+            except ValueError as e:
+                print(f"ERROR: {e}")
+                exit(1)
+    elif sys.argv[1] in {"build", "build_json"}:
         show_info("Building database...")
-        create_db(fn)
+        with metrics.span("cloud_db.build"), profiling.profile("build"):
+            create_db(fn, json_leaves=sys.argv[1] == "build_json")
         show_info("Testing database...")
-        test_data(fn)
+        with metrics.span("cloud_db.test"), profiling.profile("test"):
+            test_data(fn)
         show_info("All done")
     else:
-        lookup_ips(fn, sys.argv[1:])
+        with profiling.profile("lookup"):
+            lookup_ips(fn, sys.argv[1:])
 
 if __name__ == "__main__":
     main()
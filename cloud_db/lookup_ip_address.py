@@ -6,13 +6,16 @@
 #   https://cloud-ips.s3-us-west-2.amazonaws.com/index.html
 
 from datetime import datetime, timedelta
+from urllib.error import HTTPError
 from urllib.request import urlopen, Request
 import json
+import mmap
 import os
 import re
 import socket
 import struct
 import sys
+import threading
 if sys.version_info >= (3, 11): from datetime import UTC
 else: import datetime as datetime_fix; UTC=datetime_fix.timezone.utc
 
@@ -21,29 +24,235 @@ CLOUD_URL = "https://cloud-ips.s3-us-west-2.amazonaws.com/cloud_db.dat"
 # Filename to use if it exists
 LOCAL_FILENAME = os.path.join("data", "cloud_db.dat")
 
-# Helper to download a copy of the database and save a local cached copy
-def read_cache_local(fn):
-    # If the local copy is older than two weeks, pull down a fresh copy
-    max_age = (datetime.now(UTC).replace(tzinfo=None) - timedelta(days=14)).strftime("%Y-%m-%d %H:%M:%S")
+def load_cache_meta(fn):
+    # Load the validators and check times for the local copy, if any
+    if os.path.isfile(fn + ".meta"):
+        try:
+            with open(fn + ".meta", "rt") as f:
+                return json.load(f)
+        except Exception:
+            pass
+    return {}
 
-    if os.path.isfile(fn):
-        f = open(fn, "rb")
-        info = lookup_ip(f, "info")
-        if info['built'] >= max_age:
-            return f
-        f.close()
+def save_cache_meta(fn, meta):
+    with open(fn + ".meta", "wt", newline="") as f:
+        json.dump(meta, f, separators=(',', ':'), sort_keys=True)
+
+def newer_copy(fn):
+    # A refresh that finished while the old copy was in use is left next to
+    # it, move it into place if nothing has the old copy open.  Returns the
+    # filename of the newest copy
+    if os.path.isfile(fn + ".new"):
+        try:
+            os.replace(fn + ".new", fn)
+        except OSError:
+            # Windows won't replace a file another process has mapped, just
+            # use the new copy where it is for now
+            return fn + ".new"
+    return fn
+
+def download_cache(fn, allow_resume=True, dest=None):
+    # Bring the local copy up to date, returns True if a new copy was downloaded.
+    # The download goes to a ".partial" file first, so an interrupted download
+    # can be resumed, and the final copy is swapped into place in one step, as
+    # dest if it's given, for when the old copy is still in use
+    meta = load_cache_meta(fn)
+    partial = fn + ".partial"
+    now = datetime.now(UTC).replace(tzinfo=None).strftime("%Y-%m-%d %H:%M:%S")
+
+    headers = {}
+    resume_at = 0
+    if allow_resume and os.path.isfile(partial) and meta.get("partial_etag"):
+        # Pick up where the last download left off, as long as the object
+        # hasn't changed since then
+        resume_at = os.path.getsize(partial)
+        headers["Range"] = f"bytes={resume_at}-"
+        headers["If-Range"] = meta["partial_etag"]
+    elif os.path.isfile(fn):
+        # Only download the object if it changed from the copy we have
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        resp = urlopen(Request(CLOUD_URL, headers=headers))
+    except HTTPError as e:
+        if e.code == 304:
+            # Nothing changed, note that we checked so we don't check again for a while
+            meta["checked"] = now
+            save_cache_meta(fn, meta)
+            return False
+        if e.code == 416 and resume_at > 0:
+            # The partial file doesn't line up with the object, start over
+            # without it, so it's not tried again next time
+            os.unlink(partial)
+            del meta["partial_etag"]
+            save_cache_meta(fn, meta)
+            return download_cache(fn, allow_resume=False, dest=dest)
+        raise
 
-    # Pull down the raw data
     # Output a status message as a JSON object so consumers can easily ignore it
     print(json.dumps({"info": f"Downloading cached cloud database from {CLOUD_URL}"}))
-    with urlopen(CLOUD_URL) as f_src:
-        with open(fn, "wb") as f_dest:
+    with resp:
+        etag = resp.headers.get("ETag")
+        last_modified = resp.headers.get("Last-Modified")
+        # Remember what we're downloading, in case we need to resume it later
+        meta["partial_etag"] = etag
+        save_cache_meta(fn, meta)
+        with open(partial, "ab" if resp.status == 206 else "wb") as f_dest:
             while True:
-                data = f_src.read(1048576)
+                data = resp.read(1048576)
                 if len(data) == 0:
                     break
                 f_dest.write(data)
-    return open(fn, "rb")
+
+    os.replace(partial, fn if dest is None else dest)
+    if dest is None and os.path.isfile(fn + ".new"):
+        # Any copy left by a background refresh is older than this one
+        os.unlink(fn + ".new")
+    save_cache_meta(fn, {"etag": etag, "last_modified": last_modified, "checked": now})
+    return True
+
+# One memory mapped copy of the database, closed once it's been replaced and
+# the last lookup using it is done
+class _shared_mmap:
+    def __init__(self, fn):
+        with open(fn, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.users = 0
+        self.retired = False
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            self.users += 1
+        return self
+
+    def release(self):
+        with self.lock:
+            self.users -= 1
+            if self.retired and self.users == 0:
+                self.mm.close()
+
+    def retire(self):
+        with self.lock:
+            self.retired = True
+            if self.users == 0:
+                self.mm.close()
+
+# A file like view of a memory mapped copy with its own position, so lookups
+# don't move each other around
+class _mmap_view:
+    def __init__(self, shared):
+        self.shared = shared.acquire()
+        self.offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def close(self):
+        if self.shared is not None:
+            self.shared.release()
+            self.shared = None
+
+    def seek(self, offset):
+        self.offset = offset
+
+    def read(self, count):
+        ret = self.shared.mm[self.offset:self.offset + count]
+        self.offset += len(ret)
+        return ret
+
+# Helper to memory map the local copy of the database, this allows a new copy
+# to be swapped in without disturbing any lookups that are in progress
+class read_cache_mmap:
+    def __init__(self, fn):
+        self.fn = fn
+        self.lock = threading.Lock()
+        self.current = _shared_mmap(newer_copy(fn))
+        self.closed = False
+        self.offset = 0
+        self.refresh_thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.current.retire()
+
+    def snapshot(self):
+        # Each lookup gets its own view of one copy from start to finish, so a
+        # swap mid-lookup is harmless, call close() on it when done
+        with self.lock:
+            return _mmap_view(self.current)
+
+    def seek(self, offset):
+        self.offset = offset
+
+    def read(self, count):
+        with self.snapshot() as view:
+            view.seek(self.offset)
+            ret = view.read(count)
+        self.offset += len(ret)
+        return ret
+
+    def _swap(self, fn):
+        # Start using the new copy, the old one is closed once nothing's using it
+        new = _shared_mmap(fn)
+        with self.lock:
+            if self.closed:
+                old = new
+            else:
+                old, self.current = self.current, new
+        old.retire()
+
+    def refresh_in_background(self):
+        # Download a new copy on a background thread, and swap to it when done.
+        # Nothing waits for this to finish, if the process exits first, the
+        # next run picks up the partial download where this one left off.  The
+        # old copy is still mapped, which Windows won't let us replace, so the
+        # new copy is saved next to it, and moved into place on the next run
+        def worker():
+            try:
+                if download_cache(self.fn, dest=self.fn + ".new"):
+                    self._swap(self.fn + ".new")
+            except Exception as e:
+                print(json.dumps({"ERROR": f"ERROR: {e} refreshing cached cloud database"}))
+        self.refresh_thread = threading.Thread(target=worker, daemon=True)
+        self.refresh_thread.start()
+
+    def wait_for_refresh(self):
+        if self.refresh_thread is not None:
+            self.refresh_thread.join()
+
+# Helper to download a copy of the database and save a local cached copy
+def read_cache_local(fn, background=False):
+    # If the local copy is older than two weeks, check for a fresh copy
+    max_age = (datetime.now(UTC).replace(tzinfo=None) - timedelta(days=14)).strftime("%Y-%m-%d %H:%M:%S")
+
+    if os.path.isfile(fn):
+        f = read_cache_mmap(fn)
+        info = lookup_ip(f, "info")
+        if info['built'] >= max_age or load_cache_meta(fn).get("checked", "") >= max_age:
+            return f
+        if background:
+            # Keep using the old copy while a new one is pulled down
+            f.refresh_in_background()
+            return f
+        f.close()
+
+    download_cache(fn)
+    return read_cache_mmap(fn)
 
 # Helper to cache requests to a remote webserver
 class read_cache_remote:
@@ -88,8 +297,9 @@ class read_cache_remote:
 
         return ret
 
-def lookup_ip(db_file, ip):
-    # Lookup an IP
+def lookup_ip(db_file, ip, raw_json=False):
+    # Lookup an IP, if raw_json is set, return the results as JSON bytes, using
+    # the pre-rendered JSON in the database if it has it
 
     # First off, see if it's IPv6
     ipv6 = ":" in ip
@@ -108,17 +318,22 @@ def lookup_ip(db_file, ip):
             if isinstance(db_file, str):
                 self.f = open(db_file, "rb")
                 return self.f
+            elif hasattr(db_file, "snapshot"):
+                # Use one view of the data for the entire lookup
+                self.f = db_file.snapshot()
+                return self.f
             else:
                 return db_file
         def __exit__(self, *args, **kargs):
-            if isinstance(db_file, str):
+            if isinstance(db_file, str) or hasattr(db_file, "snapshot"):
                 self.f.close()
 
     with FileHelper() as f:
         # Seek past the header's cookie
         f.seek(21)
-        # Get the size of a field, and the location of the info dictionary
-        _, field_size, info_loc = struct.unpack("!HHQ", f.read(12))
+        # Get the size of a field, the location of the info dictionary, 
+        # and the flags to show if the data pages have pre-rendered JSON
+        _, field_size, info_loc, flags = struct.unpack("!HHQB", f.read(13))
 
         # Ok, we have the IP address as a list of bits, along with an extra
         # byte at the beggining.  We only care about the last bit from
@@ -139,6 +354,13 @@ def lookup_ip(db_file, ip):
                 # Read offset value for the given bit's value
                 offset = struct.unpack("!Q", b"\x00" * (8-field_size) + f.read(field_size))[0]
 
+        if raw_json and ip != "info" and (flags & 1) == 1:
+            # The JSON is stored just before the data page, followed by its length
+            f.seek(offset // 2 - 4)
+            size = struct.unpack("!I", f.read(4))[0]
+            f.seek(offset // 2 - 4 - size)
+            return f.read(size)
+
         def decode(f, offset):
             # Helper to decode a value, understands dicts, lists, and strings
             f.seek(offset)
@@ -195,25 +417,39 @@ def lookup_ip(db_file, ip):
             if len(item[3]) > 0:
                 item_dict['prefix'] = item[3]
             ret.append(item_dict)
+        if raw_json:
+            return json.dumps(ret).encode("utf-8")
         return ret
 
-def get_data_file():
+def get_data_file(background=False):
     if os.path.isfile(LOCAL_FILENAME):
-        return read_cache_local(LOCAL_FILENAME)
+        return read_cache_local(LOCAL_FILENAME, background=background)
     else:
         return read_cache_remote()
 
 def main():
-    if len(sys.argv) == 1:
+    args = sys.argv[1:]
+    # Optionally refresh a stale local copy while the lookups use the old copy
+    background = False
+    # Optionally output one line per IP with all results, which lets the pre-rendered
+    # JSON in the database be written out as is
+    raw = False
+    while len(args) > 0 and args[0] in {"--background", "--raw"}:
+        if args.pop(0) == "--background":
+            background = True
+        else:
+            raw = True
+
+    if len(args) == 0:
         print("Need to specify one or more IPs to lookup")
         exit(1)
 
-    with get_data_file() as f:
+    with get_data_file(background=background) as f:
         # Show the build date of the database
         info = lookup_ip(f, "info")
         print(json.dumps({"info": f"Database last built {info['built']}"}))
 
-        for ip in sys.argv[1:]:
+        for ip in args:
             # If something doesn't look like an IP, treat it as a FQDN and lookup the IP
             desc = None
             if re.match("^([0-9.]+|[0-9a-f:]+)$", ip):
@@ -232,6 +468,16 @@ def main():
                     # Dump out errors
                     print(json.dumps({"ERROR": f"ERROR: {e} for {desc}"}))
                     ip = None
+            if raw:
+                # Build up the line around the results without decoding them
+                sys.stdout.flush()
+                sys.stdout.buffer.write(
+                    b'{"ip": ' + json.dumps(ip).encode("utf-8") + 
+                    (b'' if desc is None else b', "desc": ' + json.dumps(desc).encode("utf-8")) + 
+                    b', "results": ' + (b'[]' if ip is None else lookup_ip(f, ip, raw_json=True)) + b'}\n'
+                )
+                sys.stdout.buffer.flush()
+                continue
             if ip is not None:
                 data = lookup_ip(f, ip)
             else:
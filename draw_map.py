@@ -2,11 +2,14 @@
 
 from PIL import Image, ImageDraw, ImageFont
 from netaddr import IPSet, IPNetwork
-import gzip
 import json
 import sys
 import os
 
+# Share the code that reads the data files with the collector
+sys.path.insert(0, os.path.join(os.path.split(os.path.abspath(__file__))[0], "helpers"))
+from common import codec, profiling
+
 def hilbert_xy(side_size, offset):
     x, y = 0, 0
     t = offset
@@ -61,9 +64,8 @@ def main():
 
     # Load some interesting IPv4 ranges
     for cur in ['aws', 'azure', 'google']:
-        with gzip.open(os.path.join("data", f"data_{cur}.json.gz")) as f:
-            data = json.load(f)
-            ranges[cur] = IPSet([IPNetwork(x) for x in data['v4']])
+        data = json.loads(codec.read_file(codec.find_file(os.path.join("data", f"data_{cur}.json"))))
+        ranges[cur] = IPSet([IPNetwork(x) for x in data['v4']])
 
     # Draw a very large map, we'll shrink it down later
     side_size = 2048
@@ -154,4 +156,6 @@ def add_labels(im, colors):
     return final.resize((final.width // 4, final.height // 4))
 
 if __name__ == "__main__":
-    main()
+    profiling.check_args(sys.argv)
+    with profiling.profile("draw_map"):
+        main()
@@ -1,16 +1,23 @@
 #!/usr/bin/env python3
 
 from datetime import datetime
+from hashlib import sha256
 from importlib.util import spec_from_file_location, module_from_spec
-import gzip
-import io
 import json
 import math
 import os
 import sys
+import threading
+import time
 if sys.version_info >= (3, 11): from datetime import UTC
 else: import datetime as datetime_fix; UTC=datetime_fix.timezone.utc
 
+# Let the helpers, and us, find the code they share
+sys.path.insert(0, os.path.join(os.path.split(os.path.abspath(__file__))[0], "helpers"))
+from common import codec, http_cache, metrics, profiling
+from common.streaming import RawArchive, archive_raw
+from summary_store import SummaryStore
+
 def pretty(val, show_sign=True):
     sign = ""
     if show_sign:
@@ -25,15 +32,201 @@ def pretty(val, show_sign=True):
     else:
         return f"{sign}{val}"
 
+# How many helpers to run at once
+MAX_WORKERS = 16
+# How long, in seconds, any one helper is given to finish once it starts
+HELPER_TIMEOUT = 180
+# How long, in seconds, all of the helpers are given to finish
+OVERALL_DEADLINE = 600
+
+def fetch_helper(cur):
+    # Load a helper and let it get and parse the data for its provider
+    spec = spec_from_file_location("ips", os.path.join("helpers", cur))
+    ips = module_from_spec(spec)
+    spec.loader.exec_module(ips)
+    # The feed validators are only saved once the data is written, so if
+    # anything goes wrong before then, the next run fetches it all again
+    with http_cache.deferred_validators() as validators:
+        temp = ips.get_and_parse()
+    if not isinstance(temp, dict) or 'name' not in temp:
+        raise Exception("Invalid return")
+    temp["validators"] = validators
+    return temp
+
+class HelperRunner:
+    # Run all of the helpers at the same time, so a run takes as long as the 
+    # slowest upstream source, not the sum of all of them.  The results are
+    # handed back in whatever order they're asked for.  A helper that runs
+    # past its timeout is abandoned, and gives up its slot for the others.
+    def __init__(self, helpers, max_workers=MAX_WORKERS, helper_timeout=HELPER_TIMEOUT, deadline=OVERALL_DEADLINE):
+        self.helper_timeout = helper_timeout
+        self.deadline = time.time() + deadline
+        self.gate = threading.Semaphore(max_workers)
+        self.lock = threading.Lock()
+        self.started = {}
+        self.results = {}
+        self.abandoned = set()
+        self.done = {}
+        for cur in helpers:
+            self.done[cur] = threading.Event()
+            # Daemon threads, so a helper that hangs doesn't keep us from exiting
+            threading.Thread(target=self._worker, args=(cur,), daemon=True).start()
+
+    def _abandon(self, cur):
+        # Give up on a helper, if it's running, its slot is handed to the next one
+        with self.lock:
+            if cur in self.results or cur in self.abandoned:
+                return
+            self.abandoned.add(cur)
+            if cur in self.started:
+                self.gate.release()
+
+    def _worker(self, cur):
+        self.gate.acquire()
+        with self.lock:
+            if cur in self.abandoned:
+                # Gave up on this one before it even started
+                self.gate.release()
+                self.done[cur].set()
+                return
+            self.started[cur] = time.time()
+        timer = threading.Timer(self.helper_timeout, self._abandon, (cur,))
+        timer.daemon = True
+        timer.start()
+        started = time.perf_counter()
+        try:
+            try:
+                result = (fetch_helper(cur), None)
+            except Exception as e:
+                result = (None, e)
+            timer.cancel()
+            with self.lock:
+                abandoned = cur in self.abandoned
+                if not abandoned:
+                    self.results[cur] = result
+                    self.gate.release()
+            if abandoned and result[0] is not None and isinstance(result[0].get('raw_data'), RawArchive):
+                # Nothing will use this result now, so don't leave its temp file behind
+                result[0]['raw_data'].discard()
+            err = result[1]
+            metrics.record_span("helper", time.perf_counter() - started, not abandoned and (err is None or isinstance(err, http_cache.NotModified)), helper=cur[:-3])
+        finally:
+            # Always let result() know this helper is done, even if
+            # recording how long it took fails
+            self.done[cur].set()
+
+    def result(self, cur):
+        # Wait for a helper to finish, raising its error if it failed, or if it
+        # ran past its own timeout, or the overall deadline
+        while not self.done[cur].wait(0.1):
+            if cur in self.abandoned:
+                break
+            if time.time() >= self.deadline:
+                self._abandon(cur)
+                raise Exception("Overall deadline reached")
+        with self.lock:
+            if cur in self.abandoned:
+                raise Exception(f"Timed out after {self.helper_timeout} seconds")
+            data, err = self.results[cur]
+        if err is not None:
+            raise err
+        return data
+
+MANIFEST_FILE = os.path.join("data", "manifest.json")
+
+def load_manifest():
+    # The manifest holds the hash and size of the data and raw data for each 
+    # provider, so we can tell if something changed without reading the old files,
+    # along with the validators for the feeds the data came from
+    if os.path.isfile(MANIFEST_FILE):
+        with open(MANIFEST_FILE, "rt") as f:
+            return json.load(f)
+    return {}
+
+def manifest_from_files(name):
+    # Build a manifest entry from the files on disk, only needed when
+    # there's no manifest entry for a provider yet
+    ret = {}
+    dest_name = codec.find_file(os.path.join("data", f"data_{name}.json"))
+    if dest_name is not None:
+        old_data = json.loads(codec.read_file(dest_name))
+        ret["v4_size"] = old_data.get('v4_size', 0)
+        ret["v6_size"] = old_data.get('v6_size', 0)
+        old_data["date"] = "--"
+        old_data = json.dumps(old_data, separators=(',', ':'), sort_keys=True).encode("utf-8")
+        ret["data_sha256"] = sha256(old_data).hexdigest()
+        ret["data_size"] = len(old_data)
+    # The old raw data isn't decompressed to find its hash, without a hash
+    # it's just written out again the first time
+    return ret
+
+SCHEDULE_FILE = os.path.join("data", "schedule.json")
+# The longest, in seconds, a provider can go without being fetched
+MAX_STALENESS = 7 * 24 * 60 * 60
+# How far back, in seconds, to look in the summary to see how often a provider changes
+CHANGE_WINDOW = 90 * 24 * 60 * 60
+# How much history, in seconds, a provider needs before it's fetched less than every run
+MIN_HISTORY = 14 * 24 * 60 * 60
+# How many times to check a provider for each expected change
+CHECKS_PER_CHANGE = 4
+
+def load_schedule():
+    # The schedule tracks when each helper last fetched its provider, and
+    # if the feeds were unchanged that time, keyed off the helper's filename
+    if os.path.isfile(SCHEDULE_FILE):
+        with open(SCHEDULE_FILE, "rt") as f:
+            return json.load(f)
+    return {}
+
+def parse_run_at(value):
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S").replace(tzinfo=UTC).timestamp()
+
+def fetch_intervals(now):
+    # Work out how often, in seconds, each provider needs to be fetched, based 
+    # off how often its sizes changed in the recent summary history
+    cutoff = now - CHANGE_WINDOW
+    first_seen, changes = {}, {}
+    store = SummaryStore()
+    # Start one row before the window, so the first row in it can be compared
+    start = max(0, store.index_between(cutoff, now)[0] - 1)
+    for name in store.providers:
+        last = None
+        for at, sizes in store.series(name, start):
+            if sizes is not None:
+                at = parse_run_at(at)
+                if at >= cutoff:
+                    first_seen.setdefault(name, at)
+                    if last is not None and last != sizes:
+                        changes[name] = changes.get(name, 0) + 1
+                last = sizes
+    store.close()
+
+    ret = {}
+    for name, at in first_seen.items():
+        if now - at >= MIN_HISTORY:
+            if changes.get(name, 0) > 0:
+                ret[name] = min(MAX_STALENESS, (now - at) / changes[name] / CHECKS_PER_CHANGE)
+            else:
+                ret[name] = MAX_STALENESS
+    return ret
+
+def should_fetch(info, intervals, now):
+    # Decide if a helper should run, given what happened the last time it ran
+    if info is None or "fetched" not in info or info.get("name") not in intervals:
+        # Nothing known, so always fetch
+        return True
+    interval = intervals[info["name"]]
+    if info.get("not_modified", False):
+        # The feeds answered with a conditional GET last time, so a check
+        # is cheap, check twice as often
+        interval /= 2
+    return now - parse_run_at(info["fetched"]) >= interval
+
 def create_summary():
     # Just create a summary view as a simple RSS file
-    rows = []
-    with open(os.path.join("data", "summary.jsonl"), "rt") as f:
-        for row in f:
-            row = json.loads(row)
-            rows.append(row)
-            if len(rows) > 11:
-                rows.pop(0)
+    store = SummaryStore()
+    rows = store.last(11)
+    store.close()
 
     known = set()
     for row in rows:
@@ -85,6 +278,36 @@ def create_summary():
         f.write('</rss>\n')
 
 def main():
+    max_workers, helper_timeout, deadline = MAX_WORKERS, HELPER_TIMEOUT, OVERALL_DEADLINE
+    adaptive = False
+    args = sys.argv[1:]
+    while len(args) > 0:
+        if args[0] == "--workers" and len(args) > 1:
+            max_workers = int(args[1])
+            args = args[2:]
+        elif args[0] == "--timeout" and len(args) > 1:
+            helper_timeout = float(args[1])
+            args = args[2:]
+        elif args[0] == "--deadline" and len(args) > 1:
+            deadline = float(args[1])
+            args = args[2:]
+        elif args[0] == "--codec" and len(args) > 1 and args[1] in codec.CODECS:
+            codec.DEFAULT_CODEC = args[1]
+            args = args[2:]
+        elif args[0] == "--adaptive":
+            adaptive = True
+            args = args[1:]
+        else:
+            print("Usage:")
+            print(f"  --workers <x>  - Run up to <x> helpers at once, defaults to {MAX_WORKERS}")
+            print(f"  --timeout <x>  - Give each helper <x> seconds to finish, defaults to {HELPER_TIMEOUT}")
+            print(f"  --deadline <x> - Give all helpers <x> seconds to finish, defaults to {OVERALL_DEADLINE}")
+            print(f"  --codec <x>    - Compress new data files with <x>, one of {', '.join(codec.CODECS)}, defaults to {codec.DEFAULT_CODEC}")
+            print(f"  --adaptive     - Only fetch providers that are likely to have changed, based")
+            print(f"                   off their history, or haven't been fetched in {MAX_STALENESS // 86400} days")
+            print(f"  --profile      - Profile the run, and each helper, see helpers/common/profiling.py")
+            exit(1)
+
     # A summary of this run
     run_at = datetime.now(UTC).replace(tzinfo=None).strftime("%Y-%m-%d %H:%M:%S")
     all_info = {
@@ -93,121 +316,199 @@ def main():
 
     # What the different services are properly called
     pretties = {}
+    # And what they were called last time, for any helper that has nothing new
+    old_pretties = {}
+    if os.path.isfile(os.path.join("data", "names.json")):
+        with open(os.path.join("data", "names.json")) as f:
+            old_pretties = json.load(f)
 
-    # Loop for each file in the helpers dir, and let it doe the work for its provider
-    for cur in sorted(os.listdir("helpers")):
-        if cur.endswith(".py"):
-            print(f"Working on {cur:<16} ", end="", flush=True)
-            try:
-                data = {"name": cur[:-3]}
-
-                spec = spec_from_file_location("ips", os.path.join("helpers", cur))
-                ips = module_from_spec(spec)
-                spec.loader.exec_module(ips)
-                temp = ips.get_and_parse()
-                if not isinstance(temp, dict) or 'name' not in temp:
-                    raise Exception("Invalid return")
-                data = temp
-
-                pretties[data['name']] = [data['pretty'], data['show']]
-
-                # Basic smoke test validation, if no data is found, bail out now
-                if data['v4'].size == 0:
-                    raise Exception("No IPv4 data found!")
-
-                # Add a summary to our summary dictionary
-                all_info[data['name']] = [data['v4'].size, data['v6'].size]
-
-                # Read in the old data
-                old_data = "--"
-                dest_name = os.path.join("data", f"data_{data['name']}.json.gz")
-
-                old_v4_size = 0
-                if os.path.isfile(dest_name):
-                    with gzip.open(dest_name) as f:
-                        old_data = json.load(f)
-                        old_v4_size = old_data.get('v4_size', 0)
-                        old_data["date"] = "--"
-                        old_data = json.dumps(old_data, separators=(',', ':'), sort_keys=True)
-                
-                # Create a new view of the data
-                new_data = {
-                    'date': "--",
-                    'v4': sorted([str(x) for x in data['v4'].iter_cidrs()]),
-                    'v6': sorted([str(x) for x in data['v6'].iter_cidrs()]),
-                    'v4_size': data['v4'].size,
-                    'v6_size': data['v6'].size,
-                }
-                new_data = json.dumps(new_data, separators=(',', ':'), sort_keys=True)
-
-                extra_pad = ""
-                if old_data != new_data:
-                    # Dump out the data, set the mtime so the compressed file is deterministic
-                    with io.TextIOWrapper(gzip.GzipFile(dest_name, "w", 9, mtime=0), newline="") as f:
-                        json.dump({
-                            'date': run_at,
-                            'v4': sorted([str(x) for x in data['v4'].iter_cidrs()]),
-                            'v6': sorted([str(x) for x in data['v6'].iter_cidrs()]),
-                            'v4_size': data['v4'].size,
-                            'v6_size': data['v6'].size,
-                        }, f, separators=(',', ':'), sort_keys=True)
-                    new_v4_size = data['v4'].size
-                    if new_v4_size != old_v4_size and old_v4_size > 0 and new_v4_size > 0:
-                        if new_v4_size > old_v4_size:
-                            change = f"+{new_v4_size - old_v4_size}"
-                        else:
-                            change = f"-{old_v4_size - new_v4_size}"
-                        print(f"got {data['v4'].size:>8} IPs, change by {change:>8}", flush=True, end="")
+    manifest = load_manifest()
+    # Let the helpers stop early if their feeds haven't changed since last
+    # time, as long as there's data from last time to carry forward
+    http_cache.SKIP_UNCHANGED = {x for x, y in manifest.items() if y.get("data_sha256")}
+    # The feed cache isn't checked in, so the validators from the manifest
+    # are used when there's no cached copy of a feed
+    http_cache.VALIDATORS = {x: y for cur in manifest.values() for x, y in cur.get("validators", {}).items()}
+    # The feed validators to save once everything is written
+    validators = []
+    def old_sizes(name):
+        # Find the sizes from the last time we got data for a provider
+        if name not in manifest:
+            entry = manifest_from_files(name)
+            if len(entry) == 0:
+                return None
+            manifest[name] = entry
+        if "v4_size" in manifest[name]:
+            return [manifest[name]["v4_size"], manifest[name]["v6_size"]]
+        return None
+
+    # Decide which helpers need to run this time
+    helpers = [x for x in sorted(os.listdir("helpers")) if x.endswith(".py")]
+    schedule = load_schedule()
+    to_fetch = helpers
+    if adaptive:
+        now = parse_run_at(run_at)
+        intervals = fetch_intervals(now)
+        to_fetch = [x for x in helpers if should_fetch(schedule.get(x), intervals, now) or old_sizes(schedule[x]["name"]) is None]
+
+    # Start each of them working on its provider
+    runner = HelperRunner(to_fetch, max_workers, helper_timeout, deadline)
+
+    # And handle the results in order, so the output is always the same
+    for cur in helpers:
+        print(f"Working on {cur:<16} ", end="", flush=True)
+        name = schedule.get(cur, {}).get("name", cur[:-3])
+        if cur not in to_fetch:
+            # Not due to be fetched, so just carry forward what we had last time
+            sizes = old_sizes(name)
+            all_info[name] = sizes
+            if name in old_pretties:
+                pretties[name] = old_pretties[name]
+            print(f"got {sizes[0]:>8} IPs, skipped, last fetched {schedule[cur]['fetched']}", flush=True)
+            metrics.count("helper.skipped", helper=name)
+            continue
+        try:
+            data = {"name": name}
+            data = runner.result(cur)
+            schedule[cur] = {"name": data['name'], "fetched": run_at, "not_modified": False}
+
+            pretties[data['name']] = [data['pretty'], data['show']]
+
+            # Basic smoke test validation, if no data is found, bail out now
+            if data['v4'].size == 0:
+                raise Exception("No IPv4 data found!")
+
+            # Add a summary to our summary dictionary
+            all_info[data['name']] = [data['v4'].size, data['v6'].size]
+
+            # Find what we know about the old data
+            if data['name'] not in manifest:
+                manifest[data['name']] = manifest_from_files(data['name'])
+            old_info = manifest[data['name']]
+            old_v4_size = old_info.get('v4_size', 0)
+            base_name = os.path.join("data", f"data_{data['name']}.json")
+            dest_name = base_name + codec.CODECS[codec.DEFAULT_CODEC]
+
+            # Create a new view of the data, with a placeholder date so it 
+            # can be compared to the old data
+            new_data = {
+                'date': "--",
+                'v4': sorted([str(x) for x in data['v4'].iter_cidrs()]),
+                'v6': sorted([str(x) for x in data['v6'].iter_cidrs()]),
+                'v4_size': data['v4'].size,
+                'v6_size': data['v6'].size,
+            }
+            new_data = json.dumps(new_data, separators=(',', ':'), sort_keys=True).encode("utf-8")
+            new_hash = sha256(new_data).hexdigest()
+
+            extra_pad = ""
+            if old_info.get("data_sha256") != new_hash or not os.path.isfile(dest_name):
+                # Dump out the data, the date is the first key, so just swap in the real date
+                new_data = b'{"date":' + json.dumps(run_at).encode("utf-8") + new_data[len(b'{"date":"--"'):]
+                with open(dest_name + ".tmp", "wb") as f:
+                    f.write(codec.compress(new_data, name=f"data_{data['name']}"))
+                os.replace(dest_name + ".tmp", dest_name)
+                codec.remove_others(base_name, dest_name)
+                old_info["data_sha256"] = new_hash
+                old_info["data_size"] = len(new_data)
+                old_info["v4_size"] = data['v4'].size
+                old_info["v6_size"] = data['v6'].size
+                new_v4_size = data['v4'].size
+                if new_v4_size != old_v4_size and old_v4_size > 0 and new_v4_size > 0:
+                    if new_v4_size > old_v4_size:
+                        change = f"+{new_v4_size - old_v4_size}"
                     else:
-                        print(f"got {data['v4'].size:>8} IPs", flush=True, end="")
-                        extra_pad = ' ' * 20
-                else:
-                    print(f"got {data['v4'].size:>8} IPs, no change", flush=True, end="")
-                    extra_pad = ' ' * 9
-
-                # Also log out the raw data
-                old_data = b'--'
-                dest_name = os.path.join("data", f"raw_{data['name']}.{data['raw_format']}.gz")
-                if os.path.isfile(dest_name):
-                    try:
-                        with gzip.open(dest_name, "rb") as f:
-                            old_data = f.read()
-                    except:
-                        old_data = b'--'
-                new_data = data['raw_data']
-                if data['raw_format'] == "json":
-                    new_data = json.dumps(new_data, separators=(',', ':'))
-                new_data = new_data.encode("utf-8")
-                if old_data != new_data:
-                    with gzip.open(dest_name, "wb") as f:
-                        f.write(new_data)
-                        print(f",{extra_pad} wrote {len(new_data):9d} bytes raw", flush=True)
+                        change = f"-{old_v4_size - new_v4_size}"
+                    print(f"got {data['v4'].size:>8} IPs, change by {change:>8}", flush=True, end="")
                 else:
-                    print(f",{extra_pad} no change of raw data.", flush=True)
-            except Exception as e:
-                print("ERROR: " + str(e))
-                dest_name = os.path.join("data", f"data_{data['name']}.json.gz")
-                if os.path.isfile(dest_name):
-                    with gzip.open(dest_name) as f:
-                        old_data = json.load(f)
-                        all_info[data['name']] = [old_data.get('v4_size', 0), old_data.get('v6_size', 0)]
+                    print(f"got {data['v4'].size:>8} IPs", flush=True, end="")
+                    extra_pad = ' ' * 20
+            else:
+                print(f"got {data['v4'].size:>8} IPs, no change", flush=True, end="")
+                extra_pad = ' ' * 9
+
+            # Also log out the raw data, this is hashed and compressed to a temp 
+            # file as it's encoded, so it only needs to be moved into place if it changed
+            new_data = archive_raw(data['raw_data'], data['raw_format'], data['name'])
+            data['raw_data'] = new_data
+            base_name = os.path.join("data", f"raw_{data['name']}.{data['raw_format']}")
+            dest_name = base_name + codec.CODECS[new_data.codec]
+            raw_file = os.path.basename(dest_name)
+            metrics.count("raw.bytes", new_data.size, helper=data['name'])
+            metrics.count("raw.compressed_bytes", new_data.compressed_size, helper=data['name'])
+            if old_info.get("raw_sha256") != new_data.sha256 or old_info.get("raw_file") != raw_file or not os.path.isfile(dest_name):
+                new_data.save(dest_name)
+                codec.remove_others(base_name, dest_name)
+                print(f",{extra_pad} wrote {new_data.size:9d} bytes raw", flush=True)
+                old_info["raw_file"] = raw_file
+                old_info["raw_sha256"] = new_data.sha256
+                old_info["raw_size"] = new_data.size
+            else:
+                new_data.discard()
+                print(f",{extra_pad} no change of raw data.", flush=True)
+            # Keep the validators with the data, any feed that wasn't
+            # downloaded this time keeps its old ones
+            for cur in data['validators']:
+                old_info.setdefault("validators", {})[cur["key"]] = {x: y for x, y in cur.items() if x != "key"}
+            validators.extend(data['validators'])
+        except http_cache.NotModified as e:
+            # Nothing changed upstream, so just carry forward what we had last time
+            schedule[cur] = {"name": e.name, "fetched": run_at, "not_modified": True}
+            metrics.count("helper.not_modified", helper=e.name)
+            sizes = old_sizes(e.name)
+            if sizes is not None:
+                all_info[e.name] = sizes
+                if e.name in old_pretties:
+                    pretties[e.name] = old_pretties[e.name]
+                print(f"got {all_info[e.name][0]:>8} IPs, no change", flush=True, end="")
+                print(f",{' ' * 9} no change of raw data.", flush=True)
+            else:
+                print(f"ERROR: No change to the feeds for {e.name}, but no old data to use")
+        except Exception as e:
+            print("ERROR: " + str(e))
+            metrics.count("helper.errors", helper=data['name'])
+            if isinstance(data.get('raw_data'), RawArchive):
+                data['raw_data'].discard()
+            sizes = old_sizes(data['name'])
+            if sizes is not None:
+                all_info[data['name']] = sizes
 
     # Add the new summary line
     with open(os.path.join("data", "summary.jsonl"), "at", newline="") as f:
         json.dump(all_info, f, separators=(',', ':'), sort_keys=True)
         f.write("\n")
+    # And to the summary store, this only reads the line just written
+    SummaryStore().close()
 
     # And a simple file with the latest summary line
     with open(os.path.join("data", "summary.json"), "wt", newline="") as f:
         json.dump(all_info, f, separators=(',', ':'), sort_keys=True)
         f.write("\n")
 
+    # Save the manifest for next time
+    with open(MANIFEST_FILE, "wt", newline="") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+        f.write("\n")
+
+    # And when each helper was last run
+    with open(SCHEDULE_FILE, "wt", newline="") as f:
+        json.dump(schedule, f, indent=1, sort_keys=True)
+        f.write("\n")
+
+    # Now that the data is safely written, the feeds it came from don't need
+    # to be fetched again till they change
+    http_cache.save_validators(validators)
+
     # And dump out the pretty version of each system
     with open(os.path.join("data", "names.json"), "wt", newline="") as f:
         json.dump(pretties, f, separators=(',', ':'), sort_keys=True)
 
     # And dump out the RSS summary
-    create_summary()
+    with metrics.span("summary"):
+        create_summary()
 
 if __name__ == "__main__":
-    main()
+    # The helpers are profiled on their own, since they run on other threads
+    profiling.check_args(sys.argv)
+    with profiling.profile("main"):
+        main()
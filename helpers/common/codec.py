@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+# The compression used for the files in data/ and the history archives.  Files
+# can be written with gzip or zstd, and either is read back based off the
+# magic bytes at the start of the file, so older .gz files keep working.
+#
+# zstd can use a dictionary trained on older copies of a file, since each
+# snapshot of a provider looks a lot like the last one.  The dictionaries live
+# in data/zstd_dicts, named after the file they're for, "data_aws.dict" is
+# used for "data_aws.json.zst".  Replaced dictionaries are kept with their ID
+# in the filename, so older files can still be read.
+
+import gzip
+import io
+import os
+import sys
+import threading
+
+# The extension for each codec
+CODECS = {"gzip": ".gz", "zstd": ".zst"}
+# The codec new files are written with, get_all can change this
+DEFAULT_CODEC = os.environ.get("DATA_CODEC", "gzip")
+DICT_DIR = os.path.join(os.path.split(__file__)[0], "..", "..", "data", "zstd_dicts")
+ZSTD_LEVEL = 19
+# The size of trained dictionaries, this is zstd's own default
+DICT_SIZE = 112640
+# The window used for long range archives, 128 MiB, the most a 
+# decompressor will allow by default
+LONG_WINDOW_LOG = 27
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+_dicts = None
+_dicts_lock = threading.Lock()
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception("The zstandard module is required for zstd files, run 'pip install zstandard'")
+    return zstandard
+
+def _load_dicts():
+    # Load all of the dictionaries, both by ID for reading, and by name for
+    # writing, only done once
+    global _dicts
+    with _dicts_lock:
+        if _dicts is None:
+            ret = {"id": {}, "name": {}}
+            if os.path.isdir(DICT_DIR):
+                zstandard = _zstd()
+                for cur in sorted(os.listdir(DICT_DIR)):
+                    if cur.endswith(".dict"):
+                        with open(os.path.join(DICT_DIR, cur), "rb") as f:
+                            data = zstandard.ZstdCompressionDict(f.read())
+                        ret["id"][data.dict_id()] = data
+                        if cur.count(".") == 1:
+                            ret["name"][cur[:-5]] = data
+            _dicts = ret
+        return _dicts
+
+def _compressor(name, long_range=False):
+    zstandard = _zstd()
+    if long_range:
+        # For large archives of similar files, look much further back for matches
+        params = zstandard.ZstdCompressionParameters.from_level(ZSTD_LEVEL, window_log=LONG_WINDOW_LOG, enable_ldm=True, write_checksum=True)
+        return zstandard.ZstdCompressor(compression_params=params)
+    zdict = _load_dicts()["name"].get(name) if name is not None else None
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=zdict, write_checksum=True)
+
+def compress(data, codec=None, name=None):
+    # Compress some data, name picks the dictionary to use, if there is one
+    codec = codec or DEFAULT_CODEC
+    if codec == "gzip":
+        return gzip.compress(data, 9, mtime=0)
+    elif codec == "zstd":
+        return _compressor(name).compress(data)
+    raise Exception(f"Unknown codec {codec}")
+
+def open_writer(fileobj, codec=None, name=None, long_range=False):
+    # Wrap a file so everything written to it is compressed, closing the
+    # writer finishes the compressed data, but leaves the file open.
+    # long_range is for archives, where a dictionary doesn't make sense
+    codec = codec or DEFAULT_CODEC
+    if codec == "gzip":
+        return gzip.GzipFile(filename="", mode="wb", fileobj=fileobj, compresslevel=9, mtime=0)
+    elif codec == "zstd":
+        return _compressor(name, long_range).stream_writer(fileobj, closefd=False)
+    raise Exception(f"Unknown codec {codec}")
+
+def _zstd_decompressor(data):
+    zstandard = _zstd()
+    dict_id = zstandard.get_frame_parameters(data).dict_id
+    zdict = None
+    if dict_id != 0:
+        zdict = _load_dicts()["id"].get(dict_id)
+        if zdict is None:
+            raise Exception(f"Missing zstd dictionary {dict_id}")
+    return zstandard.ZstdDecompressor(dict_data=zdict)
+
+def decompress(data):
+    # Decompress data from either codec
+    if data[:2] == GZIP_MAGIC:
+        return gzip.decompress(data)
+    elif data[:4] == ZSTD_MAGIC:
+        return _zstd_decompressor(data).decompressobj().decompress(data)
+    raise Exception("Unknown compressed data")
+
+def open_reader(fileobj):
+    # Wrap a file so reading from it decompresses it, for either codec
+    start = fileobj.read(18)
+    fileobj.seek(-len(start), io.SEEK_CUR)
+    if start[:2] == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    elif start[:4] == ZSTD_MAGIC:
+        return _zstd_decompressor(start).stream_reader(fileobj, closefd=False)
+    raise Exception("Unknown compressed data")
+
+def read_file(fn):
+    with open(fn, "rb") as f:
+        return decompress(f.read())
+
+def find_file(fn):
+    # Find a compressed copy of a file, given the name without the codec
+    # extension, returns None if there isn't one
+    for ext in CODECS.values():
+        if os.path.isfile(fn + ext):
+            return fn + ext
+    return None
+
+def remove_others(fn, keep):
+    # Remove any copies of a file made with other codecs
+    for ext in CODECS.values():
+        if fn + ext != keep and os.path.isfile(fn + ext):
+            os.unlink(fn + ext)
+
+def train(name, samples, dict_size=DICT_SIZE):
+    # Train a new dictionary from a list of samples, keeping the old one
+    # around so files made with it can still be read
+    global _dicts
+    zstandard = _zstd()
+    zdict = zstandard.train_dictionary(dict_size, samples, level=ZSTD_LEVEL)
+    if not os.path.isdir(DICT_DIR):
+        os.makedirs(DICT_DIR)
+    fn = os.path.join(DICT_DIR, name + ".dict")
+    if os.path.isfile(fn):
+        with open(fn, "rb") as f:
+            old_id = zstandard.ZstdCompressionDict(f.read()).dict_id()
+        os.replace(fn, os.path.join(DICT_DIR, f"{name}.{old_id}.dict"))
+    with open(fn, "wb") as f:
+        f.write(zdict.as_bytes())
+    with _dicts_lock:
+        _dicts = None
+    return zdict
+
+def main():
+    if len(sys.argv) >= 4 and sys.argv[1] == "train":
+        # Train a dictionary from a list of files, which can be compressed with
+        # either codec, or not at all
+        samples = []
+        for fn in sys.argv[3:]:
+            with open(fn, "rb") as f:
+                data = f.read()
+            if data[:2] == GZIP_MAGIC or data[:4] == ZSTD_MAGIC:
+                data = decompress(data)
+            samples.append(data)
+        zdict = train(sys.argv[2], samples)
+        print(f"Trained dictionary {zdict.dict_id()} for {sys.argv[2]} from {len(samples)} files")
+    else:
+        print("Usage:")
+        print("  train <name> <files...> = Train a zstd dictionary for the named files")
+        print("                            For instance: train data_aws 2025/aws/*.json")
+
+if __name__ == "__main__":
+    main()
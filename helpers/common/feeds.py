@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# The one place that fetches and parses a provider's feed.  Each helper just
+# describes its feed with a dictionary:
+#
+#   name, pretty     - The short and display names of the provider
+#   source           - One of "json", "csv", "text", or "whois"
+#   url              - The URL of the feed, or a function that returns it
+#   urls             - For "text", a list of (cache key, URL) pairs
+#   asns             - For "whois", the list of ASNs to get routes for
+#   prefixes         - For "json", a list of paths to the prefixes, see select()
+#   skip_keys        - For "json", keys to ignore when a path uses "*"
+#   min_fields       - For "csv", how many columns a row needs to be used
+#   headers          - Any extra headers to send with the request
+#   key              - The cache key, defaults to the name
+#   show             - If the provider is shown in the charts, defaults to True
+#   allowed_overlap  - Other providers this one is known to overlap with
+
+from common import metrics, profiling
+from common.http_cache import cached_get, cached_stream, check_unchanged
+from common.rangeset import RangeSet
+from common.streaming import RawArchive, csv_ranges
+from common.whois import get_routes
+from itertools import chain
+import sys
+
+# A helper run on its own takes --profile too, get_all has already taken it
+# out of its own arguments by now
+profiling.check_args(sys.argv)
+
+def _select_step(values, part, skip_keys):
+    expand = part.endswith("[]")
+    if expand:
+        part = part[:-2]
+    for value in values:
+        if len(part) == 0:
+            found = [value]
+        elif part == "*":
+            found = [y for x, y in value.items() if x not in skip_keys] if isinstance(value, dict) else []
+        elif isinstance(value, dict) and part in value:
+            found = [value[part]]
+        else:
+            found = []
+        if expand:
+            found = chain.from_iterable(x for x in found if isinstance(x, list))
+        yield from found
+
+def select(data, path, skip_keys=()):
+    # Pull the strings out of some JSON data along a path.  The path is a list
+    # of keys separated by dots, a "[]" after a key means each item in that
+    # list, and a key of "*" means every value in that object.  Anything
+    # missing or of the wrong type along the way is ignored.  For example,
+    # "prefixes[].ip_prefix" is the "ip_prefix" of each item in "prefixes"
+    values = iter([data])
+    for part in path.split("."):
+        values = _select_step(values, part, skip_keys)
+    return (x for x in values if isinstance(x, str))
+
+def _get_url(feed):
+    return feed["url"]() if callable(feed["url"]) else feed["url"]
+
+def parse_feed(feed):
+    # Get and parse a feed, returning the data get_all expects from a helper
+    with profiling.profile("feed_" + feed["name"]):
+        return _parse_feed(feed)
+
+def _parse_feed(feed):
+    name = feed["name"]
+    key = feed.get("key", name)
+    source = feed["source"]
+    headers = feed.get("headers")
+
+    if source == "json":
+        with metrics.span("feed.fetch", feed=name):
+            resp = cached_get(key, _get_url(feed), headers=headers)
+        check_unchanged(name, resp)
+        with metrics.span("feed.parse", feed=name):
+            raw_data = resp.json()
+            raw_format = "json"
+            skip_keys = feed.get("skip_keys", set())
+            v4, v6 = RangeSet.split(chain.from_iterable(select(raw_data, x, skip_keys) for x in feed["prefixes"]))
+    elif source == "csv":
+        # These feeds can be large, so they're parsed as they arrive, which
+        # means the fetch and parse can't be timed on their own
+        with metrics.span("feed.fetch", feed=name):
+            resp = cached_stream(key, _get_url(feed), headers=headers)
+        check_unchanged(name, resp)
+        with metrics.span("feed.stream", feed=name):
+            raw_data = RawArchive(name)
+            raw_format = "csv"
+            v4, v6 = csv_ranges(resp, raw_data, feed.get("min_fields", 1))
+    elif source == "text":
+        # One prefix per line, possibly spread across several URLs
+        with metrics.span("feed.fetch", feed=name):
+            resps = [cached_get(x, y, headers=headers) for x, y in feed["urls"]]
+        check_unchanged(name, *resps)
+        with metrics.span("feed.parse", feed=name):
+            raw_data = [x.text for x in resps]
+            raw_format = "json"
+            v4, v6 = RangeSet.split(x for x in chain.from_iterable(y.split("\n") for y in raw_data) if len(x.strip()))
+    elif source == "whois":
+        with metrics.span("feed.fetch", feed=name):
+            v4, v6, raw_data = get_routes(feed["asns"])
+        raw_format = "txt"
+        with metrics.span("feed.parse", feed=name):
+            v4, v6 = RangeSet(v4, 4), RangeSet(v6, 6)
+    else:
+        raise Exception(f"Unknown source type {source} for {name}")
+
+    metrics.count("feed.ranges", len(v4), feed=name, version="v4")
+    metrics.count("feed.ranges", len(v6), feed=name, version="v6")
+
+    return {
+        "name": name,
+        "pretty": feed["pretty"],
+        "v4": v4,
+        "v6": v6,
+        "show": feed.get("show", True),
+        "raw_data": raw_data,
+        "raw_format": raw_format,
+        "allowed_overlap": feed.get("allowed_overlap", set()),
+    }
+
+def show_results(data):
+    # Show the results of a helper when it's run directly
+    print(f"Results for {data['pretty']}:")
+    print(f"  IPv4: {data['v4'].size:,}")
+    print(f"  IPv6: {data['v6'].size:,}")
+    if isinstance(data['raw_data'], RawArchive):
+        data['raw_data'].discard()
+
+if __name__ == "__main__":
+    print("This module is not meant to be run directly")
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+# Conditional GET support for the helpers.  The body of each feed is kept 
+# along with the ETag and Last-Modified headers the server sent, so the next
+# run can ask the server to only send the body if it changed.  The cached
+# bodies aren't checked in, so get_all also keeps the validators in the
+# manifest.  With only the validators, a 304 is enough to know a feed didn't
+# change, and the body is only downloaded again if the helper needs it.
+
+from common import metrics
+from contextlib import contextmanager
+import json
+import os
+import threading
+
+# Where the cached feeds are stored
+CACHE_DIR = os.environ.get("FEED_CACHE_DIR", os.path.join(os.path.split(__file__)[0], "..", "..", "data", "feed_cache"))
+# The providers whose helpers stop as soon as they know none of their feeds
+# changed, rather than parsing the cached copy again.  get_all fills this in
+# with the providers it already has data for.
+SKIP_UNCHANGED = set()
+# The validators for each key, for when there's no cached copy of a feed,
+# get_all fills this in from the manifest
+VALIDATORS = {}
+
+# The validators waiting to be saved for the feeds fetched on each thread
+_pending = threading.local()
+
+class NotModified(Exception):
+    # Raised by a helper when none of its feeds changed since the last run
+    def __init__(self, name):
+        super().__init__(f"No change to the feeds for {name}")
+        self.name = name
+
+class CachedResponse:
+    # A small stand in for requests' Response, for both new and cached bodies.
+    # If there's no body, refetch is called to get it when it's needed
+    def __init__(self, url, content, encoding, not_modified, refetch=None):
+        self.url = url
+        self._content = content
+        self.encoding = encoding
+        self.not_modified = not_modified
+        self._refetch = refetch
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = self._refetch().content
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.text)
+
+class StreamedResponse:
+    # Like CachedResponse, but the body is handed out a chunk at a time as it
+    # arrives, so it can only be read once
+    def __init__(self, url, chunks, encoding, not_modified):
+        self.url = url
+        self.encoding = encoding
+        self.not_modified = not_modified
+        self._chunks = chunks
+
+    def iter_content(self):
+        return self._chunks
+
+def _cache_files(key, url):
+    # Find the cache files for a key, and load the metadata if it's for this
+    # URL, or the validators without a body if there's no cached copy
+    fn_meta = os.path.join(CACHE_DIR, f"cache_{key}.json")
+    fn_body = os.path.join(CACHE_DIR, f"cache_{key}.body")
+
+    meta = None
+    if os.path.isfile(fn_meta) and os.path.isfile(fn_body):
+        try:
+            with open(fn_meta, "rt") as f:
+                meta = json.load(f)
+        except Exception:
+            meta = None
+        if meta is not None and meta.get("url") != url:
+            meta = None
+    if meta is None and VALIDATORS.get(key, {}).get("url") == url:
+        meta = {**VALIDATORS[key], "no_body": True}
+
+    return fn_meta, fn_body, meta
+
+def _conditional_headers(meta, headers):
+    headers = dict(headers or {})
+    if meta is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
+def _save_meta(fn_meta, url, etag, last_modified, encoding):
+    with open(fn_meta + ".tmp", "wt", newline="") as f:
+        json.dump({"url": url, "etag": etag, "last_modified": last_modified, "encoding": encoding}, f)
+    os.replace(fn_meta + ".tmp", fn_meta)
+
+def _save_meta_later(key, fn_meta, url, etag, last_modified, encoding):
+    # Save the validators now, or hold on to them if the caller wants to
+    # save them itself
+    pending = getattr(_pending, "validators", None)
+    if pending is None:
+        _save_meta(fn_meta, url, etag, last_modified, encoding)
+    else:
+        pending.append({"key": key, "url": url, "etag": etag, "last_modified": last_modified, "encoding": encoding})
+
+@contextmanager
+def deferred_validators():
+    # Hold on to the validators for the feeds fetched on this thread, rather
+    # than saving them right away.  Until they're saved, the next run won't
+    # get a 304 for these feeds, so anything that goes wrong with the data
+    # before then is retried:
+    #   with http_cache.deferred_validators() as validators:
+    #       ...
+    #   http_cache.save_validators(validators)
+    _pending.validators = []
+    try:
+        yield _pending.validators
+    finally:
+        del _pending.validators
+
+def save_validators(validators):
+    # Save validators held back by deferred_validators()
+    for cur in validators:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        _save_meta(os.path.join(CACHE_DIR, f"cache_{cur['key']}.json"), cur["url"], cur["etag"], cur["last_modified"], cur["encoding"])
+
+def _requests():
+    # requests is slow to load, so it's only loaded when a feed is fetched,
+    # get_all doesn't need it just to start up
+    import requests
+    return requests
+
+def cached_get(key, url, conditional=True, **kwargs):
+    # Get a URL, only downloading the body if it changed since the last time
+    # this key was requested.  Each key holds one URL, so a feed that moves
+    # to a new URL replaces the old copy
+    fn_meta, fn_body, meta = _cache_files(key, url)
+    if not conditional:
+        meta = None
+    headers = _conditional_headers(meta, kwargs.get("headers"))
+
+    resp = _requests().get(url, **{**kwargs, "headers": headers})
+    if resp.status_code == 304 and meta is not None:
+        metrics.count("http.not_modified", key=key)
+        if meta.get("no_body"):
+            return CachedResponse(url, None, meta["encoding"], True, lambda: cached_get(key, url, False, **kwargs))
+        with open(fn_body, "rb") as f:
+            return CachedResponse(url, f.read(), meta["encoding"], True)
+    resp.raise_for_status()
+
+    ret = CachedResponse(url, resp.content, resp.encoding or resp.apparent_encoding, False)
+    metrics.count("http.bytes", len(ret.content), key=key)
+    etag, last_modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+    if etag or last_modified:
+        # Only bother storing a copy if the server gave us a way to check it later
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        with open(fn_body + ".tmp", "wb") as f:
+            f.write(ret.content)
+        os.replace(fn_body + ".tmp", fn_body)
+        _save_meta_later(key, fn_meta, url, etag, last_modified, ret.encoding)
+    return ret
+
+def _read_chunks(fn, chunk_size):
+    with open(fn, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            yield chunk
+
+def _stream_chunks(resp, key, url, fn_meta, fn_body, encoding, chunk_size):
+    # Pass along each chunk of the response, saving a copy to the cache
+    # as it goes, the cache is only updated if the whole body was read
+    etag, last_modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+    f = None
+    try:
+        if etag or last_modified:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            f = open(fn_body + ".tmp", "wb")
+        for chunk in resp.iter_content(chunk_size):
+            if f is not None:
+                f.write(chunk)
+            metrics.count("http.bytes", len(chunk), key=key)
+            yield chunk
+        if f is not None:
+            f.close()
+            f = None
+            os.replace(fn_body + ".tmp", fn_body)
+            _save_meta_later(key, fn_meta, url, etag, last_modified, encoding)
+    finally:
+        if f is not None:
+            f.close()
+            os.unlink(fn_body + ".tmp")
+        resp.close()
+
+def _refetch_chunks(key, url, chunk_size, kwargs):
+    # Download the body of a feed that's only known by its validators, only
+    # once the chunks are asked for
+    yield from cached_stream(key, url, chunk_size, False, **kwargs).iter_content()
+
+def cached_stream(key, url, chunk_size=65536, conditional=True, **kwargs):
+    # The same as cached_get, but for large feeds, the body isn't read till
+    # the caller asks for it, and then only a chunk at a time
+    fn_meta, fn_body, meta = _cache_files(key, url)
+    if not conditional:
+        meta = None
+    headers = _conditional_headers(meta, kwargs.get("headers"))
+
+    resp = _requests().get(url, stream=True, **{**kwargs, "headers": headers})
+    if resp.status_code == 304 and meta is not None:
+        metrics.count("http.not_modified", key=key)
+        resp.close()
+        if meta.get("no_body"):
+            return StreamedResponse(url, _refetch_chunks(key, url, chunk_size, kwargs), meta["encoding"], True)
+        return StreamedResponse(url, _read_chunks(fn_body, chunk_size), meta["encoding"], True)
+    try:
+        resp.raise_for_status()
+    except:
+        resp.close()
+        raise
+
+    # Without a charset, there's no way to guess the encoding without 
+    # reading the whole body first
+    encoding = resp.encoding or "utf-8"
+    return StreamedResponse(url, _stream_chunks(resp, key, url, fn_meta, fn_body, encoding, chunk_size), encoding, False)
+
+def check_unchanged(name, *responses):
+    # Stop the helper early if none of the feeds it uses changed
+    if name in SKIP_UNCHANGED and all(x.not_modified for x in responses):
+        raise NotModified(name)
+
+if __name__ == "__main__":
+    print("This module is not meant to be run directly")
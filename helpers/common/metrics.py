@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Timings and counts for every part of the pipeline, written as JSON lines so
+# runs can be compared over time, instead of reading the console output.
+# Each line is one of:
+#
+#   {"_": <date>, "type": "span", "name": <name>, "secs": <float>, ...}
+#   {"_": <date>, "type": "count", "name": <name>, "value": <int>, ...}
+#
+# along with "run", which is the same for everything from one run of a
+# script, "script", the script's name, "ok", if a span finished without an
+# error, and "labels", anything else about what was measured.  Spans are
+# written as they finish, counts are added up and written when the script
+# exits.  mimir.py can send the file on to Mimir with --metrics.
+#
+# Set METRICS_FILE to write somewhere else, or to an empty string to turn
+# this off.
+
+from contextlib import contextmanager
+from datetime import datetime
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+if sys.version_info >= (3, 11): from datetime import UTC
+else: import datetime as datetime_fix; UTC=datetime_fix.timezone.utc
+
+METRICS_FILE = os.environ.get("METRICS_FILE", os.path.join(os.path.split(__file__)[0], "..", "..", "data", "metrics.jsonl"))
+RUN_ID = f"{datetime.now(UTC).strftime('%Y%m%d%H%M%S')}-{os.getpid()}"
+SCRIPT = os.path.splitext(os.path.basename(sys.argv[0]))[0] if sys.argv[0] not in {"", "-c"} else "python"
+
+_lock = threading.Lock()
+_counts = {}
+
+def _write(row):
+    if not METRICS_FILE:
+        return
+    row = {
+        "_": datetime.now(UTC).strftime("%Y-%m-%d %H:%M:%S"),
+        "run": RUN_ID,
+        "script": SCRIPT,
+        **row,
+    }
+    data = json.dumps(row, separators=(',', ':'), sort_keys=True) + "\n"
+    with _lock:
+        # One write per line, so other processes adding to the same file
+        # don't break up each other's lines.  Losing a line is better than
+        # breaking whatever is being measured
+        try:
+            with open(METRICS_FILE, "at", newline="") as f:
+                f.write(data)
+        except OSError:
+            pass
+
+def record_span(name, secs, ok=True, **labels):
+    # Record something that's already been timed
+    _write({"type": "span", "name": name, "secs": round(secs, 6), "ok": ok, "labels": labels})
+
+@contextmanager
+def span(name, **labels):
+    # Time a block of code:
+    #   with metrics.span("helper", helper="aws"):
+    #       ...
+    started = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        record_span(name, time.perf_counter() - started, ok, **labels)
+
+def count(name, value=1, **labels):
+    # Add to a counter, these are written out when the script exits
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counts[key] = _counts.get(key, 0) + value
+
+def flush():
+    # Write out the counters, and start over
+    global _counts
+    with _lock:
+        counts, _counts = _counts, {}
+    for (name, labels), value in sorted(counts.items()):
+        _write({"type": "count", "name": name, "value": value, "labels": dict(labels)})
+
+atexit.register(flush)
+
+if __name__ == "__main__":
+    print("This module is not meant to be run directly")
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# Opt-in profiling for each stage of the pipeline.  Turn it on by passing
+# --profile to a script, including a helper run directly, or by setting
+# PROFILE_DIR for any of them.  Each stage writes two files to the profile
+# directory, named after the script, the stage, and the run:
+#
+#   <name>.pstats     - cProfile's stats, for "python -m pstats" or snakeviz
+#   <name>.collapsed  - Sampled stacks, one "a;b;c count" per line, ready for
+#                       flamegraph.pl, speedscope, or inferno
+#
+# When profiling is off, profile() hands back a context that does nothing.
+# Only one cProfile can run at a time, since newer versions of Python only
+# allow one per process, so a stage inside another profiled stage, or on
+# another thread at the same time, only gets the sampled stacks.
+
+from common.metrics import RUN_ID, SCRIPT
+from contextlib import contextmanager, nullcontext
+import os
+import re
+import sys
+import threading
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "")
+DEFAULT_DIR = os.path.join(os.path.split(__file__)[0], "..", "..", "profiles")
+# How often to sample the stack for the collapsed stacks
+SAMPLE_INTERVAL = 0.005
+
+# Set while a stage is being profiled with cProfile
+_cprofile_lock = threading.Lock()
+
+def enable(profile_dir=None):
+    # Turn on profiling, also for any scripts run from this one
+    global PROFILE_DIR
+    PROFILE_DIR = profile_dir or PROFILE_DIR or DEFAULT_DIR
+    os.environ["PROFILE_DIR"] = PROFILE_DIR
+
+def check_args(args):
+    # Pull "--profile" out of a list of arguments, turning on profiling if
+    # it was there
+    if "--profile" in args:
+        args.remove("--profile")
+        enable()
+    return args
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+class _Sampler:
+    # Sample the stack of one thread from another thread, which unlike
+    # cProfile, keeps the full path to each function
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.stacks = {}
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stop.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if len(stack) > 0:
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def finish(self):
+        self.stop.set()
+        self.thread.join()
+        return self.stacks
+
+@contextmanager
+def _profile(stage):
+    import cProfile
+
+    if not os.path.isdir(PROFILE_DIR):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, re.sub("[^A-Za-z0-9_.-]", "_", f"{SCRIPT}-{stage}-{RUN_ID}"))
+
+    profiler = None
+    if _cprofile_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Some other profiler is already running, the sampled stacks
+            # still work
+            _cprofile_lock.release()
+            profiler = None
+    sampler = _Sampler(threading.get_ident())
+    try:
+        yield
+    finally:
+        stacks = sampler.finish()
+        if profiler is not None:
+            profiler.disable()
+            _cprofile_lock.release()
+            profiler.dump_stats(base + ".pstats")
+        with open(base + ".collapsed", "wt", newline="") as f:
+            for stack, count in sorted(stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+def profile(stage):
+    # Profile a block of code, if profiling is turned on:
+    #   with profiling.profile("build"):
+    #       ...
+    if not PROFILE_DIR:
+        return nullcontext()
+    return _profile(stage)
+
+if __name__ == "__main__":
+    print("This module is not meant to be run directly")
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# A simple set of IP ranges, stored as sorted lists of integer start and end
+# addresses.  This does the small part of what netaddr's IPSet does that the
+# helpers need, without creating an object for each prefix.
+
+from bisect import bisect_right
+import socket
+
+_FAMILIES = {4: (socket.AF_INET, 32), 6: (socket.AF_INET6, 128)}
+
+def parse_prefix(prefix):
+    # Turn a prefix string into the IP version, and the first and last address,
+    # any host bits in the prefix are ignored, just like netaddr does
+    prefix = prefix.strip()
+    ip, _, bits = prefix.partition("/")
+    version = 6 if ":" in ip else 4
+    family, max_bits = _FAMILIES[version]
+    try:
+        value = int.from_bytes(socket.inet_pton(family, ip), "big")
+        bits = int(bits) if len(bits) else max_bits
+    except (OSError, ValueError):
+        raise ValueError(f"Invalid prefix: {prefix!r}")
+    if bits < 0 or bits > max_bits:
+        raise ValueError(f"Invalid prefix: {prefix!r}")
+    host = (1 << (max_bits - bits)) - 1
+    return version, value & ~host, (value & ~host) | host
+
+def format_prefix(version, value, bits):
+    family, max_bits = _FAMILIES[version]
+    return socket.inet_ntop(family, value.to_bytes(max_bits // 8, "big")) + "/" + str(bits)
+
+class RangeSet:
+    __slots__ = ("version", "starts", "ends")
+
+    def __init__(self, prefixes=(), version=None):
+        # Build a set from prefix strings, all of which need to be the same IP version
+        ranges = []
+        for prefix in prefixes:
+            cur_version, first, last = parse_prefix(prefix)
+            if version is None:
+                version = cur_version
+            elif version != cur_version:
+                raise ValueError(f"Mix of IPv{version} and IPv{cur_version} prefixes")
+            ranges.append((first, last))
+        self._set_ranges(version, ranges)
+
+    @classmethod
+    def split(cls, prefixes):
+        # Build an IPv4 set and an IPv6 set from a mix of prefix strings
+        ranges = {4: [], 6: []}
+        for prefix in prefixes:
+            version, first, last = parse_prefix(prefix)
+            ranges[version].append((first, last))
+        return cls.from_ranges(4, ranges[4]), cls.from_ranges(6, ranges[6])
+
+    @classmethod
+    def from_ranges(cls, version, ranges):
+        # Build a set from (first, last) integer pairs
+        ret = cls.__new__(cls)
+        ret._set_ranges(version, ranges)
+        return ret
+
+    def _set_ranges(self, version, ranges):
+        # Sort the ranges, and merge any that overlap or touch
+        self.version = version
+        self.starts, self.ends = [], []
+        for first, last in sorted(ranges):
+            if len(self.ends) > 0 and first <= self.ends[-1] + 1:
+                if last > self.ends[-1]:
+                    self.ends[-1] = last
+            else:
+                self.starts.append(first)
+                self.ends.append(last)
+
+    def ranges(self):
+        return zip(self.starts, self.ends)
+
+    @property
+    def size(self):
+        return sum(self.ends) - sum(self.starts) + len(self.starts)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __eq__(self, other):
+        return isinstance(other, RangeSet) and self.starts == other.starts and self.ends == other.ends and (len(self.starts) == 0 or self.version == other.version)
+
+    def __contains__(self, ip):
+        version = 6 if ":" in ip else 4
+        if version != self.version:
+            return False
+        value = int.from_bytes(socket.inet_pton(_FAMILIES[version][0], ip), "big")
+        i = bisect_right(self.starts, value) - 1
+        return i >= 0 and value <= self.ends[i]
+
+    def _check_version(self, other):
+        if len(self.starts) > 0 and len(other.starts) > 0 and self.version != other.version:
+            raise ValueError(f"Can't combine IPv{self.version} and IPv{other.version} sets")
+        return self.version if self.version is not None else other.version
+
+    def union(self, other):
+        version = self._check_version(other)
+        return RangeSet.from_ranges(version, list(self.ranges()) + list(other.ranges()))
+
+    def intersection(self, other):
+        # Walk through both lists of ranges at the same time
+        ret = []
+        if len(self.starts) == 0 or len(other.starts) == 0 or self.version != other.version:
+            return RangeSet.from_ranges(self.version, ret)
+        i, j = 0, 0
+        while i < len(self.starts) and j < len(other.starts):
+            first = max(self.starts[i], other.starts[j])
+            last = min(self.ends[i], other.ends[j])
+            if first <= last:
+                ret.append((first, last))
+            if self.ends[i] < other.ends[j]:
+                i += 1
+            else:
+                j += 1
+        return RangeSet.from_ranges(self.version, ret)
+
+    __or__ = union
+    __and__ = intersection
+
+    def iter_cidrs(self):
+        # Return the smallest list of CIDR strings that cover this set, in order
+        if self.version is None:
+            return
+        max_bits = _FAMILIES[self.version][1]
+        for first, last in self.ranges():
+            while first <= last:
+                # Find the biggest block that starts here, and doesn't go past the end
+                bits = max_bits if first == 0 else min(max_bits, (first & -first).bit_length() - 1)
+                while first + (1 << bits) - 1 > last:
+                    bits -= 1
+                yield format_prefix(self.version, first, max_bits - bits)
+                first += 1 << bits
+
+if __name__ == "__main__":
+    print("This module is not meant to be run directly")
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# Helpers for large line oriented feeds.  The feed is parsed into integer
+# ranges as it arrives, and the raw bytes are compressed to a temp file at the
+# same time, so neither the text of the feed nor an object per row need to
+# be kept around.
+
+from common import codec
+from common.rangeset import RangeSet, parse_prefix
+from hashlib import sha256
+import codecs
+import json
+import os
+import shutil
+import tempfile
+
+# Temp files are made next to the final data files when possible, so they
+# can just be renamed into place
+TEMP_DIR = os.path.join(os.path.split(__file__)[0], "..", "..", "data")
+# How much text to gather before handing it to the compressor
+CHUNK_SIZE = 65536
+
+class RawArchive:
+    # The raw data for a helper, compressed as it's written.  The hash and size
+    # of the uncompressed data are tracked so the caller can tell if it changed.
+    # The name of the provider picks the compression dictionary, if any
+    def __init__(self, name=None):
+        fd, self.temp_name = tempfile.mkstemp(prefix="raw_", suffix=".tmp", dir=TEMP_DIR if os.path.isdir(TEMP_DIR) else None)
+        self.codec = codec.DEFAULT_CODEC
+        self._file = os.fdopen(fd, "wb")
+        self._writer = codec.open_writer(self._file, self.codec, None if name is None else "raw_" + name)
+        self._hash = sha256()
+        self.size = 0
+        self.sha256 = None
+        self.compressed_size = None
+
+    def write(self, data):
+        self._writer.write(data)
+        self._hash.update(data)
+        self.size += len(data)
+
+    def close(self):
+        if self.sha256 is None:
+            self._writer.close()
+            self._file.close()
+            self.sha256 = self._hash.hexdigest()
+            self.compressed_size = os.path.getsize(self.temp_name)
+
+    def save(self, dest_name):
+        # Move the compressed data into its final place
+        self.close()
+        shutil.move(self.temp_name, dest_name)
+        self.temp_name = None
+
+    def discard(self):
+        # Nothing needs this data, just clean up the temp file
+        if self.temp_name is not None:
+            self.close()
+            os.unlink(self.temp_name)
+            self.temp_name = None
+
+def archive_raw(raw_data, raw_format, name=None):
+    # Compress and hash the raw data from a helper, a piece at a time, so the
+    # whole of it is never encoded at once.  Helpers that streamed their feed
+    # already did this work.
+    if isinstance(raw_data, RawArchive):
+        raw_data.close()
+        return raw_data
+
+    if raw_format == "json":
+        pieces = json.JSONEncoder(separators=(',', ':')).iterencode(raw_data)
+    else:
+        pieces = (raw_data[i:i + CHUNK_SIZE] for i in range(0, len(raw_data), CHUNK_SIZE))
+
+    ret = RawArchive(name)
+    try:
+        buffer, buffered = [], 0
+        for piece in pieces:
+            buffer.append(piece)
+            buffered += len(piece)
+            if buffered >= CHUNK_SIZE:
+                ret.write("".join(buffer).encode("utf-8"))
+                buffer, buffered = [], 0
+        ret.write("".join(buffer).encode("utf-8"))
+        ret.close()
+    except:
+        ret.discard()
+        raise
+    return ret
+
+def iter_lines(chunks, encoding):
+    # Turn chunks of bytes into lines of text, without ever holding more
+    # than a chunk and a partial line
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    pending = ""
+    for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).split("\n")
+        pending = lines.pop()
+        yield from lines
+    pending += decoder.decode(b"", final=True)
+    if len(pending):
+        yield pending
+
+def csv_ranges(resp, archive, min_fields=1):
+    # Parse a CSV feed where the first column is a prefix into a set of
+    # IPv4 and IPv6 ranges, copying the raw bytes into the archive along the way
+    def copy_chunks():
+        for chunk in resp.iter_content():
+            archive.write(chunk)
+            yield chunk
+
+    ranges = {4: [], 6: []}
+    try:
+        for row in iter_lines(copy_chunks(), resp.encoding):
+            row = row.strip()
+            if len(row) == 0 or row.startswith("#"):
+                continue
+            row = row.split(",", min_fields)
+            if len(row) >= min_fields:
+                version, first, last = parse_prefix(row[0])
+                ranges[version].append((first, last))
+        archive.close()
+    except:
+        archive.discard()
+        raise
+
+    return RangeSet.from_ranges(4, ranges[4]), RangeSet.from_ranges(6, ranges[6])
+
+if __name__ == "__main__":
+    print("This module is not meant to be run directly")
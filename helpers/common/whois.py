@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# A shared whois client for the helpers that pull routes from RADb.  All of
+# the queries are sent down one connection, using IRRd's "!!" mode to keep
+# the connection open.  Each query is followed by a "!v" version query, the
+# answer to that is length prefixed, which marks where one answer ends and
+# the next begins, so all the queries can be sent before reading any answers.
+
+import re
+import socket
+import threading
+
+WHOIS_HOST = "whois.radb.net"
+WHOIS_PORT = 43
+WHOIS_TIMEOUT = 10
+
+class WhoisError(Exception):
+    pass
+
+class WhoisClient:
+    def __init__(self, host=WHOIS_HOST, port=WHOIS_PORT, timeout=WHOIS_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.pending = bytearray()
+        # Only one batch of queries can use the connection at a time
+        self.lock = threading.Lock()
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.pending = bytearray()
+
+    def _connect(self):
+        self.close()
+        try:
+            self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            self.sock.sendall(b"!!\n")
+        except OSError as e:
+            self.close()
+            raise WhoisError(f"Unable to connect to {self.host}: {e}")
+
+    def _fill(self):
+        try:
+            chunk = self.sock.recv(65536)
+        except OSError as e:
+            raise WhoisError(f"Error reading from {self.host}: {e}")
+        if len(chunk) == 0:
+            raise WhoisError(f"{self.host} closed the connection")
+        self.pending += chunk
+
+    def _read_line(self):
+        while True:
+            i = self.pending.find(b"\n")
+            if i >= 0:
+                line = bytes(self.pending[:i]).rstrip(b"\r")
+                del self.pending[:i + 1]
+                return line.decode("utf-8", errors="replace")
+            self._fill()
+
+    def _read_bytes(self, count):
+        while len(self.pending) < count:
+            self._fill()
+        ret = bytes(self.pending[:count])
+        del self.pending[:count]
+        return ret
+
+    def _read_answer(self):
+        # Read the answer to one query, pulling out the routes as each line
+        # arrives, until we see the answer to "!v"
+        ret = {"v4": [], "v6": [], "lines": []}
+        while True:
+            line = self._read_line()
+            m = re.match("^A([0-9]+)$", line)
+            if m is not None:
+                self._read_bytes(int(m.group(1)))
+                while True:
+                    line = self._read_line()
+                    if line == "C":
+                        return ret
+                    if line.startswith("F"):
+                        raise WhoisError(f"{self.host} returned an error: {line[1:].strip()}")
+            ret["lines"].append(line)
+            if line.startswith("route:"):
+                ret["v4"].append(line[6:].strip())
+            elif line.startswith("route6:"):
+                ret["v6"].append(line[7:].strip())
+
+    def query_origins(self, asns):
+        # Send a "-i origin" query for each ASN at once, then read each answer
+        # in turn, returns a list of answers in the same order as the ASNs
+        with self.lock:
+            for attempt in range(2):
+                if self.sock is None:
+                    self._connect()
+                try:
+                    query = "".join(f"-i origin {asn}\r\n!v\r\n" for asn in asns)
+                    self.sock.sendall(query.encode("utf-8"))
+                    return [self._read_answer() for _ in asns]
+                except (WhoisError, OSError) as e:
+                    self.close()
+                    # The server may have dropped an idle connection, so try once more
+                    if attempt == 1:
+                        raise WhoisError(f"Unable to query {self.host} for {', '.join(asns)}: {e}")
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    # All of the helpers share one client, and so one connection
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = WhoisClient()
+        return _client
+
+def get_routes(asns):
+    # Get all of the routes for a list of ASNs, returns the IPv4 and IPv6 
+    # routes, along with the raw text of the answers
+    v4, v6, lines = [], [], []
+    for answer in get_client().query_origins(asns):
+        v4.extend(answer["v4"])
+        v6.extend(answer["v6"])
+        lines.extend(answer["lines"])
+    return v4, v6, "\n".join(lines) + "\n"
+
+if __name__ == "__main__":
+    print("This module is not meant to be run directly")
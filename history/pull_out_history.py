@@ -2,10 +2,25 @@
 
 from datetime import datetime, timedelta
 from hashlib import sha256
-import gzip
 import json
 import os
 import subprocess
+import sys
+import tarfile
+
+# Share the code that reads and writes compressed files with the collector
+sys.path.insert(0, os.path.join(os.path.split(os.path.abspath(__file__))[0], "..", "helpers"))
+from common import codec
+
+# Keep each archive under this size
+MAX_ARCHIVE_SIZE = 95 * 1024 * 1024
+
+def is_archived(year):
+    # See if there's already an archive for a given year, with any codec
+    for ext in codec.CODECS.values():
+        if os.path.isfile(f"{year}.tar{ext}") or os.path.isfile(f"{year}_01.tar{ext}"):
+            return True
+    return False
 
 def process_raw_history():
     seen = set()
@@ -31,7 +46,7 @@ def process_raw_history():
     for row in log.split("\n"):
         commit, at = row.split(' ')
         at = epoch + timedelta(seconds=int(at))
-        if os.path.isfile(str(at.year) + ".tar.gz") or os.path.isfile(str(at.year) + "_01.tar.gz"):
+        if is_archived(at.year):
             break
         data = subprocess.check_output(["git", "diff-tree", "--no-commit-id", "-r", commit]).decode("utf-8")
         for file in data.split("\n"):
@@ -39,7 +54,7 @@ def process_raw_history():
                 info, file = file.split("\t")
                 info = info.split(" ")
                 if info[4] in {"A", "C", "M", "R"}:
-                    if file.startswith("data/raw_") and (file.endswith(".json.gz") or file.endswith(".csv.gz") or file.endswith(".txt.gz")):
+                    if file.startswith("data/raw_") and file.split(".")[-2] in {"json", "csv", "txt"} and "." + file.split(".")[-1] in codec.CODECS.values():
                         provider = file.split("/")[-1].split(".")[0][4:]
                         dn = os.path.join(str(at.year), "raw", provider)
                         if not os.path.isdir(dn):
@@ -49,7 +64,7 @@ def process_raw_history():
                             print(f"Raw {provider:<12}:{info[3]}, ", end="", flush=True)
                             if not os.path.isfile(fn):
                                 data = subprocess.check_output(["git", "cat-file", "-p", info[3]])
-                                data = gzip.decompress(data)
+                                data = codec.decompress(data)
                                 hash = sha256(data).hexdigest()
                                 if hash not in seen:
                                     seen.add(hash)
@@ -61,25 +76,27 @@ def process_raw_history():
                             else:
                                 print("file exists.", flush=True)
 
-def process_history(years, fn, provider):
+def process_history(years, provider):
     seen = set()
 
-    cmd = "git rev-list --all --objects -- ../data/" + fn
+    # The data file might have been written with any of the codecs
+    fns = {f"data/data_{provider}.json{ext}" for ext in codec.CODECS.values()}
+    cmd = "git rev-list --all --objects -- " + " ".join("../" + x for x in sorted(fns))
     history = subprocess.check_output(cmd.split(' ')).decode("utf8")
     for row in history.split("\n"):
         row = row.strip().split(' ')
-        if len(row) == 2 and row[1] == "data/" + fn:
+        if len(row) == 2 and row[1] in fns:
             print(f"Working on {provider:<12}:{row[0]}", end="", flush=True)
             cmd = "git cat-file -p " + row[0]
             data = subprocess.check_output(cmd.split(' '))
-            data = gzip.decompress(data)
+            data = codec.decompress(data)
             hash = sha256(data).hexdigest()
             if hash in seen:
                 print(", dupe detected", flush=True)
             else:
                 seen.add(hash)
                 time = datetime(*[int(x) for x in json.loads(data)['date'][:19].replace(" ", "-").replace(":", "-").split("-")])
-                if os.path.isfile(time.strftime("%Y") + ".tar.gz") or os.path.isfile(time.strftime("%Y") + "_01.tar.gz"):
+                if is_archived(time.strftime("%Y")):
                     print(", already archived " + time.strftime("%Y-%m-%d %H:%M:%S"), flush=True)
                     break
                 else:
@@ -94,12 +111,60 @@ def process_history(years, fn, provider):
                         f.write(data)
                     print(", created file for " + time.strftime("%Y-%m-%d %H:%M:%S"), flush=True)
 
+def write_archives(year, files, codec_name):
+    # Write the files for a year to as few archives as possible, watching the
+    # compressed size as each file is added, so there's no need to guess the
+    # compression ratio ahead of time
+    ext = ".tar" + codec.CODECS[codec_name]
+    archives = []
+    out, writer, tar = None, None, None
+    for file in files:
+        if tar is None:
+            archives.append(f"{year}_{len(archives)+1:02d}{ext}")
+            print("# Writing " + archives[-1])
+            out = open(archives[-1], "wb")
+            writer = codec.open_writer(out, codec_name, long_range=True)
+            tar = tarfile.open(fileobj=writer, mode="w|", format=tarfile.GNU_FORMAT)
+        info = tar.gettarinfo(file['full_name'])
+        info.uid, info.gid, info.uname, info.gname = 0, 0, "root", "root"
+        with open(file['full_name'], "rb") as f:
+            tar.addfile(info, f)
+        if out.tell() >= MAX_ARCHIVE_SIZE:
+            tar.close()
+            writer.close()
+            out.close()
+            tar = None
+    if tar is not None:
+        tar.close()
+        writer.close()
+        out.close()
+
+    if len(archives) == 1:
+        # Only one archive, so no need to number it
+        os.rename(archives[0], f"{year}{ext}")
+        archives = [f"{year}{ext}"]
+
+    for dest_fn in archives:
+        print(f"# {dest_fn} is {os.path.getsize(dest_fn):,} bytes")
+        if os.path.getsize(dest_fn) >= 100 * 1024 * 1024:
+            raise Exception(f"{dest_fn} is too big!")
+
 def main():
+    codec_name = "gzip"
+    if len(sys.argv) == 3 and sys.argv[1] == "--codec" and sys.argv[2] in codec.CODECS:
+        codec_name = sys.argv[2]
+    elif len(sys.argv) > 1:
+        print("Usage:")
+        print(f"  --codec <x> - Compress archives with <x>, one of {', '.join(codec.CODECS)}, defaults to gzip")
+        exit(1)
+
     years = set()
+    providers = set()
     for cur in sorted(os.listdir(os.path.join("..", "data"))):
-        if cur.startswith("data_") and cur.endswith(".json.gz"):
-            provider = cur[5:-8]
-            process_history(years, cur, provider)
+        if cur.startswith("data_") and cur.split(".")[-1] in {x[1:] for x in codec.CODECS.values()}:
+            providers.add(cur[5:].split(".")[0])
+    for provider in sorted(providers):
+        process_history(years, provider)
 
     process_raw_history()
 
@@ -116,58 +181,8 @@ def main():
 
         # Sort by filename, in other words, sort by date
         files.sort(key=lambda x: x['fn'])
-        batches = []
-
-        # Try to find the compression ratio
-        test_batch = {
-            "size": 0,
-            "files": [],
-        }
-        for file in files:
-            test_batch["size"] += file['size']
-            test_batch["files"].append(file)
-            if test_batch["size"] >= (50 * 1024 * 1024):
-                break
-        with open("_temp_files", "wt") as f:
-            for cur in test_batch['files']:
-                f.write(cur['full_name'] + "\n")
-        dest_fn = "test_batch.tar.gz"
-        cmd = f"tar --owner=0 --group=0 -T _temp_files -czf {dest_fn}"
-        print("$ " + cmd)
-        subprocess.check_call(cmd, shell=True)
-        os.unlink('_temp_files')
-        # Give ourselves a 10% buffer for future files
-        test_batch["actual_compressed"] = os.path.getsize(dest_fn)
-        test_batch["compressed"] = int(os.path.getsize(dest_fn) * 1.1)
-        os.unlink(dest_fn)
-        compression_ratio = test_batch['size'] / test_batch['compressed']
-        print(f"# Got an expected ratio of {compression_ratio:.2f}")
-
-        for file in files:
-            # Given the test file compressed, try to limit filesize to 95 MiB
-            if len(batches) == 0 or batches[-1]['size'] >= (95 * 1024 * 1024) * compression_ratio:
-                batches.append({'files': [], 'size': 0, 'id': ''})
-            batches[-1]['files'].append(file)
-            batches[-1]['size'] += file['size']
-
-        if len(batches) > 1:
-            for i, batch in enumerate(batches):
-                batch['id'] = f"_{i+1:02d}"
-
-        for batch in batches:
-            with open("_temp_files", "wt") as f:
-                for cur in batch['files']:
-                    f.write(cur['full_name'] + "\n")
-            dest_fn = f"{year}{batch['id']}.tar.gz"
-            cmd = f"tar --owner=0 --group=0 -T _temp_files -czf {dest_fn}"
-            print("$ " + cmd)
-            subprocess.check_call(cmd, shell=True)
-            os.unlink('_temp_files')
-            actual_size = os.path.getsize(dest_fn)
-            expected_size = int(batch['size'] / (test_batch['size'] / test_batch['actual_compressed']))
-            print(f"# File size is {actual_size:,}, expected {expected_size:,}, that's {abs(expected_size - actual_size)/actual_size*100:.2f}% off")
-            if os.path.getsize(dest_fn) >= 100 * 1024 * 1024:
-                raise Exception(f"{dest_fn} is too big!")
+        write_archives(year, files, codec_name)
+
         cmd = f"rm -rf {year}"
         print("$ " + cmd)
         subprocess.check_call(cmd, shell=True)
@@ -3,10 +3,15 @@
 from netaddr import IPSet, IPNetwork
 import json
 import os
+import sys
 import tarfile
 
+# Share the code that reads compressed files with the collector
+sys.path.insert(0, os.path.join(os.path.split(os.path.abspath(__file__))[0], "..", "helpers"))
+from common import codec
+
 def get_history(provider):
-    # Load all history files for a given provider, including history files inside of .tar.gz files
+    # Load all history files for a given provider, including history files inside of .tar.gz or .tar.zst files
     dirs = [(".", "")]
     while len(dirs) > 0:
         cur_dir, cur_pretty = dirs.pop(0)
@@ -16,8 +21,8 @@ def get_history(provider):
             if os.path.isdir(cur):
                 dirs.append((cur, pretty))
             else:
-                if cur.endswith(".tar.gz"):
-                    with tarfile.open(cur, "r:gz") as tar:
+                if any(cur.endswith(".tar" + x) for x in codec.CODECS.values()):
+                    with open(cur, "rb") as f, tarfile.open(fileobj=codec.open_reader(f), mode="r|") as tar:
                         for obj in tar:
                             if obj.name.endswith(".json"):
                                 temp = obj.name.split("/")
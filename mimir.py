@@ -1,16 +1,22 @@
+import argparse
 import calendar
 import json
+import random
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from hashlib import sha256
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional
 
 import requests
 
 from prometheus_pb2 import (
     WriteRequest
 )
+from summary_store import SummaryStore
 
 try:
     import snappy
@@ -27,186 +33,333 @@ def dt2ts(dt):
     return calendar.timegm(dt.utctimetuple())
 
 
-def send_to_mimir(timestamp: datetime, provider: str,type:str, value: int, mimir_url: str, auth: tuple) -> None:
+# Headers for every remote write request
+HEADERS = {
+    "Content-Encoding": "snappy",
+    "Content-Type": "application/x-protobuf",
+    "X-Prometheus-Remote-Write-Version": "0.1.0",
+    "User-Agent": "metrics-worker"
+}
+# The rough size of a WriteRequest, before compression, to send at once
+MAX_BATCH_BYTES = 1024 * 1024
+# How many requests can be sent at once
+MAX_IN_FLIGHT = 4
+# How many times to retry a request, and how long to wait before the first retry
+MAX_RETRIES = 5
+RETRY_BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+# The encoded size of one sample, a double and a timestamp, with their tags
+SAMPLE_BYTES = 22
+
+
+class RemoteWriter:
     """
-    Send metric to Mimir using HTTP POST with Snappy compression
-    Raises exception if the request fails
+    Send samples to Mimir's remote write endpoint, packing as many series and
+    samples as fit in max_bytes into each WriteRequest.  Like Prometheus, each
+    series is always sent by the same shard, and each shard sends one request
+    at a time, so samples for a series arrive in order, while up to
+    max_in_flight requests are sent at once over one pooled session
     """
-    write_request = WriteRequest()
 
-    series = write_request.timeseries.add()
+    def __init__(self, url: str, auth: tuple, max_bytes: int = MAX_BATCH_BYTES,
+                 max_in_flight: int = MAX_IN_FLIGHT, max_retries: int = MAX_RETRIES,
+                 backoff: float = RETRY_BACKOFF) -> None:
+        self.url = url
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.headers.update(HEADERS)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.shards = [ThreadPoolExecutor(max_workers=1) for _ in range(max_in_flight)]
+        # Limit how many batches can be waiting, so a backfill doesn't build
+        # the whole history in memory
+        self.queued = threading.BoundedSemaphore(max_in_flight * 2)
+        self.pending = [self._new_batch() for _ in range(max_in_flight)]
+        self.futures = []
+        self.error = None
+        self.samples_sent = 0
+        self.requests_sent = 0
+        self.lock = threading.Lock()
+
+    def _new_batch(self) -> dict:
+        return {"request": WriteRequest(), "series": {}, "size": 0, "samples": 0}
+
+    def add(self, labels: dict, timestamp_ms: int, value: float) -> None:
+        """
+        Add one sample to the series with the given labels
+        """
+        if self.error is not None:
+            raise self.error
+        key = tuple(sorted(labels.items()))
+        shard = hash(key) % len(self.shards)
+        batch = self.pending[shard]
+        series = batch["series"].get(key)
+        if series is None:
+            series = batch["request"].timeseries.add()
+            for name, label_value in key:
+                label = series.labels.add()
+                label.name = name
+                label.value = label_value
+                batch["size"] += len(name.encode("utf-8")) + len(label_value.encode("utf-8")) + 6
+            batch["series"][key] = series
+        sample = series.samples.add()
+        sample.value = value
+        sample.timestamp = timestamp_ms
+        batch["size"] += SAMPLE_BYTES
+        batch["samples"] += 1
+        if batch["size"] >= self.max_bytes:
+            self._flush_shard(shard)
+
+    def _flush_shard(self, shard: int) -> None:
+        batch = self.pending[shard]
+        if batch["samples"] == 0:
+            return
+        self.pending[shard] = self._new_batch()
+        self.queued.acquire()
+        future = self.shards[shard].submit(self._send, batch["request"], batch["samples"])
+        future.add_done_callback(lambda _: self.queued.release())
+        self.futures.append(future)
+        self.futures = [x for x in self.futures if not x.done() or x.exception() is not None]
+
+    def _send(self, write_request: WriteRequest, samples: int) -> None:
+        if self.error is not None:
+            # Something already failed, don't bother sending more
+            return
+        compressed = snappy.compress(write_request.SerializeToString())
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(self.url, data=compressed)
+            except requests.RequestException as e:
+                problem = f"{e}"
+            else:
+                if response.status_code // 100 == 2:
+                    with self.lock:
+                        self.samples_sent += samples
+                        self.requests_sent += 1
+                    return
+                problem = f"{response.status_code} - {response.text}"
+                # Only server errors and rate limits are worth retrying, like
+                # Prometheus, anything else won't work the next time either
+                if response.status_code != 429 and response.status_code < 500:
+                    break
+            if attempt < self.max_retries:
+                delay = min(MAX_BACKOFF, self.backoff * (2 ** attempt))
+                time.sleep(delay / 2 + random.random() * delay / 2)
+        self.error = RuntimeError(f"Error sending {samples} samples: {problem}")
+        raise self.error
+
+    def flush(self) -> None:
+        """
+        Send everything added so far, and wait for it to finish
+        """
+        for shard in range(len(self.shards)):
+            self._flush_shard(shard)
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+        if self.error is not None:
+            raise self.error
+
+    def close(self) -> None:
+        """
+        Wait for any requests still being sent and shut down, call flush()
+        first to send anything that's left
+        """
+        for shard in self.shards:
+            shard.shutdown()
+        self.session.close()
+
+
+def process_json_data(data: dict, writer: RemoteWriter, line_number: Optional[int] = None) -> None:
+    """
+    Add the metrics from a single JSON data entry to the writer
+    """
+    try:
+        timestamp = dt2ts(datetime.strptime(data['_'], '%Y-%m-%d %H:%M:%S')) * 1000
 
-    # name label always required
-    label = series.labels.add()
-    label.name = "__name__"
-    label.value = "cloud_provider_ips_pool_size"
+        # Process each provider's data
+        for provider, values in data.items():
+            # Skip the timestamp field
+            if provider == '_':
+                continue
 
-    # as many labels you like
-    label = series.labels.add()
-    label.name = "name"
-    label.value = provider
+            # Send the IPv4 and IPv6 counts
+            if isinstance(values, list) and len(values) > 1:
+                for type, value in (("v4", values[0]), ("v6", values[1])):
+                    writer.add({
+                        # name label always required
+                        "__name__": "cloud_provider_ips_pool_size",
+                        "name": provider,
+                        "type": type,
+                    }, timestamp, value)
 
-    label = series.labels.add()
-    label.name = "type"
-    label.value = type
+    except Exception as e:
+        error_msg = f"Unexpected error at line {line_number}: {e}" if line_number else f"Unexpected error processing data: {e}"
+        print(error_msg)
+        raise
 
-    sample = series.samples.add()
-    sample.value = value  # your count?
-    sample.timestamp = dt2ts(timestamp) * 1000
 
-    uncompressed = write_request.SerializeToString()
-    compressed = snappy.compress(uncompressed)
+def load_checkpoint(checkpoint_path: Path) -> Optional[dict]:
+    """
+    Load the checkpoint left by the last run, or None if there isn't one
+    """
+    if not checkpoint_path.exists():
+        return None
+    with open(checkpoint_path, 'r') as f:
+        return json.load(f)
 
-    headers = {
-        "Content-Encoding": "snappy",
-        "Content-Type": "application/x-protobuf",
-        "X-Prometheus-Remote-Write-Version": "0.1.0",
-        "User-Agent": "metrics-worker"
-    }
-    try:
-        response = requests.post(mimir_url, headers=headers, auth=auth,
-                                 data=compressed)
-    except Exception as e:
-        raise RuntimeError(f"Error sending metric for {provider}: {e}")
 
-    if response.status_code != 200:
-        raise RuntimeError(f"Error sending metric for {provider}: {response.status_code} - {response.text}")
+def save_checkpoint(checkpoint_path: Path, checkpoint: dict) -> None:
+    """
+    Save the checkpoint, replacing the old one in one step so a crash can't
+    leave half of it behind
+    """
+    temp_path = checkpoint_path.with_name(checkpoint_path.name + ".tmp")
+    with open(temp_path, 'w', newline='') as f:
+        json.dump(checkpoint, f, indent=1)
+        f.write("\n")
+    temp_path.replace(checkpoint_path)
 
 
-def process_json_data(data: dict, mimir_url: str, username: str, password: str,
-                      line_number: Optional[int] = None) -> None:
+def count_lines(file_path: Path, offset: int) -> int:
+    """
+    Count the lines in the file before a byte offset
+    """
+    ret = 0
+    with open(file_path, 'rb') as f:
+        while offset > 0:
+            chunk = f.read(min(offset, 1048576))
+            if len(chunk) == 0:
+                break
+            ret += chunk.count(b"\n")
+            offset -= len(chunk)
+    return ret
+
+
+def find_start(file_path: Path, checkpoint: dict) -> tuple:
     """
-    Process a single JSON data entry and send metrics to Mimir
+    Find where to start reading for a checkpoint, as a byte offset, the
+    timestamp of the last row already sent, and the line number of the first
+    row to read.  If the file no longer matches the checkpoint, it's read
+    from the start, skipping rows that were sent
     """
+    with open(file_path, 'rb') as f:
+        f.seek(checkpoint["last_line"])
+        last_line = f.read(checkpoint["offset"] - checkpoint["last_line"])
+    if sha256(last_line).hexdigest() == checkpoint["last_sha256"]:
+        if "line" in checkpoint:
+            return checkpoint["offset"], None, checkpoint["line"] + 1
+        # Checkpoints from before line numbers were saved
+        return checkpoint["offset"], None, count_lines(file_path, checkpoint["offset"]) + 1
+    print(f"Warning: {file_path} changed since the last run, looking for rows after {checkpoint['last_timestamp']}")
+    return 0, checkpoint["last_timestamp"], 1
+
+
+def find_last_offset(file_path: Path) -> tuple:
+    """
+    Return the byte offset and line number of the last row of the JSONL file
+    """
+    # The summary store already knows where the last row starts
+    store = SummaryStore(str(file_path))
     try:
-        timestamp = datetime.strptime(data['_'], '%Y-%m-%d %H:%M:%S')
+        return store.meta["last_line"], max(store.meta["rows"], 1)
+    finally:
+        store.close()
 
-        # Process each provider's data
-        for provider, values in data.items():
-            # Skip the timestamp field
-            if provider == '_':
-                continue
 
-            # Extract the IPv4 count (first element of the array)
-            if isinstance(values, list) and len(values) > 0:
-                ipv4_count = values[0]
-                try:
-                    # Send metric to Mimir
-                    send_to_mimir(
-                        timestamp=timestamp,
-                        provider=provider,
-                        type="v4",
-                        value=ipv4_count,
-                        mimir_url=f"{mimir_url}/api/v1/push",
-                        auth=(username, password)
-                    )
-                    print(f"Successfully sent metric for {provider}: {ipv4_count}")
-
-                except Exception as e:
-                    error_msg = f"Error at line {line_number}: {str(e)}" if line_number else f"Error sending metric: {str(e)}"
-                    print(error_msg)
-                    raise
-
-                # Add a small delay to avoid overwhelming the server
-                time.sleep(0.1)
-
-                ipv6_count = values[1]
-                try:
-                    # Send metric to Mimir
-                    send_to_mimir(
-                        timestamp=timestamp,
-                        provider=ipv6_count,
-                        type="v6",
-                        value=ipv4_count,
-                        mimir_url=f"{mimir_url}/api/v1/push",
-                        auth=(username, password)
-                    )
-                    print(f"Successfully sent metric for {provider}: {ipv4_count}")
-
-                except Exception as e:
-                    error_msg = f"Error at line {line_number}: {str(e)}" if line_number else f"Error sending metric: {str(e)}"
-                    print(error_msg)
-                    raise
-
-                # Add a small delay to avoid overwhelming the server
-                time.sleep(0.1)
+def process_metrics_data(data: dict, writer: RemoteWriter, line_number: Optional[int] = None) -> None:
+    """
+    Add a single span or count from the pipeline's metrics file to the writer
+    """
+    try:
+        timestamp = dt2ts(datetime.strptime(data['_'], '%Y-%m-%d %H:%M:%S')) * 1000
+        labels = {x: str(y) for x, y in data.get("labels", {}).items()}
+        labels["name"] = data["name"]
+        labels["script"] = data["script"]
+        if data["type"] == "span":
+            labels["__name__"] = "cloud_sizes_span_seconds"
+            labels["ok"] = "true" if data["ok"] else "false"
+            writer.add(labels, timestamp, data["secs"])
+        elif data["type"] == "count":
+            labels["__name__"] = "cloud_sizes_run_count"
+            writer.add(labels, timestamp, data["value"])
 
     except Exception as e:
-        if not isinstance(e, json.JSONDecodeError):  # Don't wrap JSON errors
-            error_msg = f"Unexpected error at line {line_number}: {e}" if line_number else f"Unexpected error processing data: {e}"
-            print(error_msg)
+        error_msg = f"Unexpected error at line {line_number}: {e}" if line_number else f"Unexpected error processing data: {e}"
+        print(error_msg)
         raise
 
 
-def process_file(file_path: Path, mimir_url: str, username: str, password: str) -> None:
+def process_file(file_path: Path, writer: RemoteWriter, offset: int = 0,
+                 skip_through: Optional[str] = None,
+                 handler: Callable = process_json_data,
+                 first_line: int = 1) -> Optional[dict]:
     """
-    Process the entire JSONL file and send metrics to Mimir
+    Process the JSONL file from a byte offset and send metrics to Mimir,
+    skipping any rows at or before skip_through.  Each row is turned into
+    samples by handler.  first_line is the line number of the row at the
+    offset, for error messages.  Returns the checkpoint for the end of the
+    file, or None if there were no rows.
     Stops processing if any error occurs
     """
-    with open(file_path, 'r') as f:
-        for line_number, line in enumerate(f, 1):
+    checkpoint = None
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        for line_number, line in enumerate(f, first_line):
+            if not line.endswith(b"\n"):
+                # A row that's still being written, leave it for next time
+                break
             try:
-                data = json.loads(line.strip())
-                process_json_data(data, mimir_url, username, password, line_number)
+                data = json.loads(line)
+                if skip_through is None or data['_'] > skip_through:
+                    handler(data, writer, line_number)
             except json.JSONDecodeError as e:
                 print(f"Error parsing JSON at line {line_number}: {e}")
                 sys.exit(1)
             except Exception as e:
-                sys.exit(1)  # Error message already printed in process_json_data
-
-
-def process_last_line(file_path: Path, mimir_url: str, username: str, password: str) -> None:
-    """
-    Process only the last line of the JSONL file and send metrics to Mimir
-    Stops processing if any error occurs
-    """
+                sys.exit(1)  # Error message already printed by the handler
+            checkpoint = {
+                "offset": offset + len(line),
+                "last_line": offset,
+                "last_sha256": sha256(line).hexdigest(),
+                "last_timestamp": data['_'],
+                "line": line_number,
+            }
+            offset += len(line)
     try:
-        # Read the last line of the file
-        with open(file_path, 'r') as f:
-            last_line = find_last_line(f)
-
-        if last_line == -1:
-            return
-
-            # Process the last line
-        try:
-            data = json.loads(last_line.strip())
-            process_json_data(data, mimir_url, username, password)
-        except json.JSONDecodeError as e:
-            print(f"Error parsing JSON in last line: {e}")
-            sys.exit(1)
-        except Exception as e:
-            sys.exit(1)  # Error message already printed in process_json_data
-
+        writer.flush()
     except Exception as e:
-        print(f"Error reading file: {e}")
+        print(f"Error sending metrics: {e}")
         sys.exit(1)
+    return checkpoint
 
 
-def find_last_line(f):
-    # Move cursor to the end of file
-    f.seek(0, 2)
-    file_size = f.tell()
-
-    # If file is empty, return
-    if file_size == 0:
-        print("File is empty")
-        return -1
-    # Start from the end and read backwards until we find a newline
-    position = file_size - 1
-    while position >= 0:
-        f.seek(position)
-        char = f.read(1)
-        if char == '\n' and position != file_size - 1:
-            # Found the last complete line
-            last_line = f.readline()
-            break
-        position -= 1
+def process_new_lines(file_path: Path, writer: RemoteWriter, checkpoint_path: Path,
+                      backfill: bool = False, metrics: bool = False) -> None:
+    """
+    Send every row added since the last run, and move the checkpoint past
+    them once they've been sent.  Without a checkpoint, only the last row
+    of the summary is sent, unless backfilling the full history.  For the
+    metrics file, everything is sent the first time
+    """
+    checkpoint = None if backfill else load_checkpoint(checkpoint_path)
+    if checkpoint is not None:
+        offset, skip_through, first_line = find_start(file_path, checkpoint)
+    elif backfill or metrics:
+        offset, skip_through, first_line = 0, None, 1
     else:
-        # If we didn't find a newline, read the entire file as one line
-        f.seek(0)
-        last_line = f.readline()
-    return last_line
+        (offset, first_line), skip_through = find_last_offset(file_path), None
+
+    handler = process_metrics_data if metrics else process_json_data
+    new_checkpoint = process_file(file_path, writer, offset, skip_through, handler, first_line)
+    if new_checkpoint is None:
+        print("No new rows")
+    else:
+        save_checkpoint(checkpoint_path, new_checkpoint)
 
 
 def main():
@@ -215,14 +368,33 @@ def main():
     USERNAME = "your-username"
     PASSWORD = "your-password"
     FILE_PATH = Path("data/summary.jsonl")
+    CHECKPOINT_PATH = Path("data/mimir_checkpoint.json")
+    METRICS_PATH = Path("data/metrics.jsonl")
+    METRICS_CHECKPOINT_PATH = Path("data/mimir_metrics_checkpoint.json")
+
+    parser = argparse.ArgumentParser(description="Send the summary data to Mimir")
+    parser.add_argument("--backfill", action="store_true", help="Send the full history, not just the rows since the last run")
+    parser.add_argument("--metrics", action="store_true", help="Send the pipeline's own timings and counts, not the summary")
+    parser.add_argument("--url", default=MIMIR_URL, help="The base URL of Mimir")
+    parser.add_argument("--max-bytes", type=int, default=MAX_BATCH_BYTES, help="The rough size of each request")
+    parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT, help="How many requests to send at once")
+    args = parser.parse_args()
+
+    if args.metrics:
+        FILE_PATH, CHECKPOINT_PATH = METRICS_PATH, METRICS_CHECKPOINT_PATH
 
     if not FILE_PATH.exists():
         print(f"Error: File not found at {FILE_PATH}")
         sys.exit(1)
 
     print(f"Starting to process {FILE_PATH}")
-    process_last_line(FILE_PATH, MIMIR_URL, USERNAME, PASSWORD)
-    print("Processing complete")
+    writer = RemoteWriter(f"{args.url}/api/v1/push", (USERNAME, PASSWORD),
+                          max_bytes=args.max_bytes, max_in_flight=args.max_in_flight)
+    try:
+        process_new_lines(FILE_PATH, writer, CHECKPOINT_PATH, args.backfill, args.metrics)
+    finally:
+        writer.close()
+    print(f"Processing complete, sent {writer.samples_sent:,} samples in {writer.requests_sent:,} requests")
 
 
 if __name__ == "__main__":
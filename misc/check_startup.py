@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# Check how long each scheduled entry point takes to start, using Python's
+# "-X importtime", and that none of them load the heavy modules that only
+# some of their work needs.  Exits with an error if anything is over budget,
+# so it can be run along with the other checks.  Pass a number to scale all
+# of the budgets, for slower machines.
+
+import os
+import subprocess
+import sys
+
+BASE_DIR = os.path.join(os.path.split(os.path.abspath(__file__))[0], "..")
+
+# Each entry point, as the directory it runs from, the module, the most time
+# importing it should take, in milliseconds, and modules it shouldn't load
+ENTRY_POINTS = [
+    ("", "get_all", 50, {"requests", "matplotlib", "PIL", "netaddr", "boto3"}),
+    ("", "update_data", 60, {"matplotlib", "PIL", "netaddr", "boto3", "multiprocessing", "importlib.metadata"}),
+    ("cloud_db", "cloud_db", 50, {"netaddr", "matplotlib", "PIL", "boto3"}),
+    ("misc", "show_logs", 20, {"boto3"}),
+]
+# Import times are noisy, so take the best of a few runs
+RUNS = 3
+
+def measure(directory, module):
+    # Import a module in a new interpreter, returns the time it took in
+    # milliseconds, and all of the modules it loaded, or None if it failed
+    best = None
+    for _ in range(RUNS):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=os.path.join(BASE_DIR, directory),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        if result.returncode != 0:
+            return None, set()
+        total = None
+        loaded = set()
+        for row in result.stderr.decode("utf-8").split("\n"):
+            # Each row is "import time: self | cumulative | name", with the
+            # name indented by how deep the import is
+            row = row.split("|")
+            if len(row) != 3 or not row[1].strip().isdigit():
+                continue
+            loaded.add(row[2].strip())
+            if row[2].strip() == module and not row[2].startswith("  "):
+                total = int(row[1]) / 1000
+        if total is None:
+            raise Exception(f"No import time found for {module}")
+        best = total if best is None else min(best, total)
+    return best, loaded
+
+def main():
+    budget_scale = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    failed = False
+    for directory, module, budget, forbidden in ENTRY_POINTS:
+        took, loaded = measure(directory, module)
+        budget *= budget_scale
+        heavy = sorted(x for x in forbidden if any(y == x or y.startswith(x + ".") for y in loaded))
+        status = "ok"
+        if took is None:
+            print(f"{os.path.join(directory, module + '.py'):<24} FAILED TO IMPORT")
+            failed = True
+            continue
+        if took > budget:
+            status = "OVER BUDGET"
+            failed = True
+        if len(heavy) > 0:
+            status = "LOADS " + ", ".join(heavy)
+            failed = True
+        print(f"{os.path.join(directory, module + '.py'):<24} {took:8.2f}ms / {budget:6.0f}ms  {status}")
+    if failed:
+        exit(1)
+
+if __name__ == "__main__":
+    main()
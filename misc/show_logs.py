@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 from datetime import datetime, timedelta
-import boto3
 import sys
 import os
 import re
@@ -12,7 +11,14 @@ AWS_PROFILE = "pers"
 AWS_REGION = "us-west-2"
 LOG_GROUP_NAME = "/aws/lambda/trackCloudSizes"
 
-_client = boto3.Session(profile_name=AWS_PROFILE).client('logs', region_name=AWS_REGION)
+_client = None
+def get_client():
+    # Only connect when a command needs it
+    global _client
+    if _client is None:
+        import boto3
+        _client = boto3.Session(profile_name=AWS_PROFILE).client('logs', region_name=AWS_REGION)
+    return _client
 
 def show_quick():
     recent(quick_only=True)
@@ -29,7 +35,7 @@ def recent(quick_only=False):
     last_msg = ""
     msgs = []
     at_end = False
-    for cur in _client.get_paginator('describe_log_streams').paginate(**args):
+    for cur in get_client().get_paginator('describe_log_streams').paginate(**args):
         for stream in cur['logStreams']:
             at = epoch + timedelta(seconds=stream['lastEventTimestamp'] / 1000)
             if at < oldest:
@@ -47,7 +53,7 @@ def recent(quick_only=False):
             info = ""
             detected = set()
             while True:
-                resp = _client.get_log_events(**args)
+                resp = get_client().get_log_events(**args)
                 for event in resp['events']:
                     if len(info) == 0:
                         info = (epoch + timedelta(seconds=event['timestamp']/1000)).strftime("%d %H:%M:%S") + ": " + event['message']
@@ -88,7 +94,7 @@ def recent(quick_only=False):
 
 
 def show_groups():
-    for cur in _client.get_paginator('describe_log_groups').paginate():
+    for cur in get_client().get_paginator('describe_log_groups').paginate():
         for group in cur['logGroups']:
             print(group['logGroupName'])
 
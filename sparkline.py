@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# Draw the simple line charts used for each provider's history directly as
+# SVG files.  This looks close to the matplotlib charts, with the same dark
+# style, axes, and labels, but without the cost of loading matplotlib.
+
+from datetime import timedelta
+from html import escape
+import math
+
+# Change this if the way charts are drawn changes, to force them to be redrawn
+SVG_VERSION = 1
+
+# The size of the chart, the same as an 8x2 inch matplotlib figure at 100 dpi
+WIDTH, HEIGHT = 800, 200
+# The space around the plot for the labels
+LEFT, RIGHT, TOP, BOTTOM = 72, 10, 8, 26
+# Colors from matplotlib's dark_background style
+BACKGROUND = "#000000"
+FOREGROUND = "#ffffff"
+LINE_COLOR = "#8dd3c7"
+FONT = "DejaVu Sans, Bitstream Vera Sans, Arial, sans-serif"
+
+def nice_ticks(low, high, max_ticks=8):
+    # Pick evenly spaced tick values, using steps of 1, 2, 2.5, or 5 times
+    # a power of 10, like matplotlib does
+    if high <= low:
+        return [low]
+    raw_step = (high - low) / max_ticks
+    scale = 10 ** math.floor(math.log10(raw_step))
+    for mult in (1, 2, 2.5, 5, 10):
+        step = mult * scale
+        if (high - low) / step <= max_ticks:
+            break
+    first = math.ceil(low / step - 1e-9)
+    last = math.floor(high / step + 1e-9)
+    return [i * step for i in range(first, last + 1)]
+
+def draw_history_svg(dest, xaxis, history, min_y, max_y, label, epoch):
+    # Draw the percent change over time for one provider, takes the same
+    # arguments as the matplotlib version in update_data
+    min_x, max_x = min(xaxis), max(xaxis)
+    if max_x <= min_x:
+        max_x = min_x + 1
+    plot_w = WIDTH - LEFT - RIGHT
+    plot_h = HEIGHT - TOP - BOTTOM
+
+    def to_x(value):
+        return LEFT + (value - min_x) / (max_x - min_x) * plot_w
+
+    def to_y(value):
+        return TOP + (max_y - value) / (max_y - min_y) * plot_h
+
+    out = []
+    out.append(f'<svg xmlns="http://www.w3.org/2000/svg" width="{WIDTH}" height="{HEIGHT}" viewBox="0 0 {WIDTH} {HEIGHT}">')
+    out.append(f'<rect width="{WIDTH}" height="{HEIGHT}" fill="{BACKGROUND}"/>')
+    out.append(f'<clipPath id="plot"><rect x="{LEFT}" y="{TOP}" width="{plot_w}" height="{plot_h}"/></clipPath>')
+    out.append(f'<g font-family="{FONT}" font-size="13" fill="{FOREGROUND}">')
+
+    # The ticks and labels along the bottom, as month-day
+    for value in nice_ticks(min_x, max_x):
+        x = to_x(value)
+        out.append(f'<line x1="{x:.2f}" y1="{TOP + plot_h}" x2="{x:.2f}" y2="{TOP + plot_h + 4}" stroke="{FOREGROUND}"/>')
+        out.append(f'<text x="{x:.2f}" y="{HEIGHT - 6}" text-anchor="middle">{(epoch + timedelta(days=value)).strftime("%m-%d")}</text>')
+
+    # And along the side, as a percent
+    for value in nice_ticks(min_y, max_y, 5):
+        y = to_y(value)
+        out.append(f'<line x1="{LEFT - 4}" y1="{y:.2f}" x2="{LEFT}" y2="{y:.2f}" stroke="{FOREGROUND}"/>')
+        out.append(f'<text x="{LEFT - 7}" y="{y + 4.5:.2f}" text-anchor="end">{int(value):d}%</text>')
+
+    out.append(f'<text transform="translate(16,{TOP + plot_h / 2:.2f}) rotate(-90)" text-anchor="middle">{escape(label)}</text>')
+    out.append('</g>')
+
+    # The line itself, clipped to the plot, just like matplotlib does
+    points = " ".join(f"{to_x(x):.2f},{to_y(y):.2f}" for x, y in zip(xaxis, history))
+    out.append(f'<polyline points="{points}" fill="none" stroke="{LINE_COLOR}" stroke-width="4.17" stroke-linejoin="round" stroke-linecap="square" clip-path="url(#plot)"/>')
+    out.append(f'<rect x="{LEFT}" y="{TOP}" width="{plot_w}" height="{plot_h}" fill="none" stroke="{FOREGROUND}"/>')
+    out.append('</svg>')
+
+    with open(dest, "wt", newline="") as f:
+        f.write("\n".join(out) + "\n")
+
+if __name__ == "__main__":
+    print("This module is not meant to be run directly")
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+# A column store that mirrors data/summary.jsonl, so the tools that only need
+# the last few rows, or one provider's history, don't need to parse all of the
+# JSON each time.  The store lives in data/summary_store:
+#
+#   meta.json     - How much of summary.jsonl is in the store, and the providers
+#   dates.bin     - The date of each row, as seconds since the epoch, int64
+#   <name>.bin    - For each provider, three uint64 per row: the IPv4 count, and
+#                   the high and low halves of the IPv6 count.  Rows where the
+#                   provider is missing have an IPv4 count of MISSING
+#
+# The store is brought up to date with any new rows in summary.jsonl each time
+# it's opened, so it can always be deleted and it'll be rebuilt.  get_all adds
+# each new row as it writes it, and the store is checked in along with the
+# rest of data/, so a fresh checkout doesn't have to build it from scratch.
+# Only one process at a time updates the store, the others wait on the lock
+# file in it.
+
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from hashlib import sha256
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows, where only threads in this process are kept apart
+    fcntl = None
+if sys.version_info >= (3, 11): from datetime import UTC
+else: import datetime as datetime_fix; UTC=datetime_fix.timezone.utc
+
+SUMMARY_FILE = os.path.join("data", "summary.jsonl")
+STORE_VERSION = 2
+MISSING = 2 ** 64 - 1
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+_sync_lock = threading.Lock()
+
+def to_timestamp(value):
+    # Turn a date from the summary, or a datetime, into seconds since the epoch
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.strptime(value, DATE_FORMAT)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=UTC)
+    return int(value.timestamp())
+
+def from_timestamp(value):
+    return datetime.fromtimestamp(value, UTC).strftime(DATE_FORMAT)
+
+class _Column:
+    # A file of fixed width values, viewed as a list of integers
+    def __init__(self, fn, fmt):
+        self.fn = fn
+        self.fmt = fmt
+        self._mm = None
+        self._raw = None
+        self.view = []
+        if os.path.isfile(self.fn) and os.path.getsize(self.fn) > 0:
+            with open(self.fn, "rb") as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._raw = memoryview(self._mm)
+            self.view = self._raw.cast(self.fmt)
+
+    def close(self):
+        if self._mm is not None:
+            self.view.release()
+            self._raw.release()
+            self._mm.close()
+            self._mm = None
+        self.view = []
+
+class SummaryStore:
+    def __init__(self, summary_file=SUMMARY_FILE, store_dir=None):
+        # The store is kept next to the summary file, unless told otherwise
+        self.summary_file = summary_file
+        self.store_dir = store_dir or os.path.join(os.path.dirname(summary_file), "summary_store")
+        self.meta = None
+        self._dates = None
+        self._columns = {}
+        self.sync()
+
+    def _meta_file(self):
+        return os.path.join(self.store_dir, "meta.json")
+
+    def _column_file(self, name):
+        return os.path.join(self.store_dir, name + ".bin")
+
+    def _load_meta(self):
+        # Load the metadata, and make sure the store still matches the start
+        # of summary.jsonl, if it doesn't, start over
+        meta = None
+        if os.path.isfile(self._meta_file()):
+            with open(self._meta_file(), "rt") as f:
+                meta = json.load(f)
+            if meta.get("version") != STORE_VERSION:
+                meta = None
+        if meta is not None and meta["offset"] > 0:
+            with open(self.summary_file, "rb") as f:
+                f.seek(meta["last_line"])
+                last_line = f.read(meta["offset"] - meta["last_line"])
+            if sha256(last_line).hexdigest() != meta["last_sha256"]:
+                meta = None
+        if meta is None:
+            meta = {"version": STORE_VERSION, "offset": 0, "last_line": 0, "last_sha256": "", "rows": 0, "providers": []}
+        return meta
+
+    def _column_width(self, name):
+        return 8 if name == "dates" else 24
+
+    def _check_sizes(self, meta):
+        # Make sure every column holds exactly the rows the metadata says
+        for cur in ["dates"] + meta["providers"]:
+            fn = self._column_file(cur)
+            size = os.path.getsize(fn) if os.path.isfile(fn) else 0
+            if size != meta["rows"] * self._column_width(cur):
+                raise Exception(f"Summary store column {cur} is the wrong size")
+
+    def _truncate(self, meta):
+        # Drop anything written after the metadata was last saved
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+        names = ["dates"] + meta["providers"]
+        for cur in os.listdir(self.store_dir):
+            if cur.endswith(".bin") and cur[:-4] not in names:
+                os.unlink(os.path.join(self.store_dir, cur))
+        for cur in names:
+            fn = self._column_file(cur)
+            size = meta["rows"] * self._column_width(cur)
+            if not os.path.isfile(fn) and size == 0:
+                with open(fn, "wb") as f:
+                    pass
+            if not os.path.isfile(fn) or os.path.getsize(fn) != size:
+                # Either an update never finished, or something else wrote to
+                # the column, there's no telling which rows are good
+                raise Exception(f"Summary store column {cur} is the wrong size")
+
+    def sync(self):
+        # Add any rows in summary.jsonl that aren't in the store yet, only one
+        # thread or process can do this at once
+        self.close()
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir, exist_ok=True)
+        with _sync_lock, open(os.path.join(self.store_dir, "lock"), "ab") as f_lock:
+            if fcntl is not None:
+                fcntl.flock(f_lock.fileno(), fcntl.LOCK_EX)
+            try:
+                self._sync()
+                self._check_sizes(self.meta)
+            except Exception:
+                # Something's wrong with the store, start over from scratch
+                self.close()
+                self._reset()
+                self._sync()
+                self._check_sizes(self.meta)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f_lock.fileno(), fcntl.LOCK_UN)
+
+    def _reset(self):
+        # Remove everything in the store, so it's built again from scratch
+        for cur in os.listdir(self.store_dir):
+            if cur == "meta.json" or cur.endswith(".bin"):
+                os.unlink(os.path.join(self.store_dir, cur))
+
+    def _sync(self):
+        meta = self._load_meta()
+        try:
+            self._truncate(meta)
+        except Exception:
+            self._reset()
+            meta = {"version": STORE_VERSION, "offset": 0, "last_line": 0, "last_sha256": "", "rows": 0, "providers": []}
+            self._truncate(meta)
+
+        size = os.path.getsize(self.summary_file) if os.path.isfile(self.summary_file) else 0
+        if size > meta["offset"]:
+            files = {}
+            try:
+                with open(self.summary_file, "rb") as f:
+                    f.seek(meta["offset"])
+                    for row in f:
+                        if not row.endswith(b"\n"):
+                            # A partial line, leave it till it's finished
+                            break
+                        meta["last_line"] = meta["offset"]
+                        meta["last_sha256"] = sha256(row).hexdigest()
+                        meta["offset"] += len(row)
+                        row = json.loads(row)
+
+                        if "dates" not in files:
+                            files["dates"] = open(self._column_file("dates"), "ab")
+                        files["dates"].write(struct.pack("<q", to_timestamp(row["_"])))
+
+                        for name in row:
+                            if name != "_" and name not in meta["providers"]:
+                                # A new provider, fill in all of the rows before now
+                                meta["providers"].append(name)
+                                with open(self._column_file(name), "wb") as f_col:
+                                    f_col.write(struct.pack("<QQQ", MISSING, 0, 0) * meta["rows"])
+                        for name in meta["providers"]:
+                            if name not in files:
+                                files[name] = open(self._column_file(name), "ab")
+                            if name in row:
+                                v4, v6 = row[name]
+                                files[name].write(struct.pack("<QQQ", v4, v6 >> 64, v6 & (2 ** 64 - 1)))
+                            else:
+                                files[name].write(struct.pack("<QQQ", MISSING, 0, 0))
+                        meta["rows"] += 1
+            finally:
+                for f in files.values():
+                    f.close()
+
+            with open(self._meta_file() + ".tmp", "wt", newline="") as f:
+                json.dump(meta, f, indent=1)
+                f.write("\n")
+            os.replace(self._meta_file() + ".tmp", self._meta_file())
+
+        self.meta = meta
+        self._dates = _Column(self._column_file("dates"), "q")
+
+    def close(self):
+        if self._dates is not None:
+            self._dates.close()
+            self._dates = None
+        for cur in self._columns.values():
+            cur.close()
+        self._columns = {}
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    @property
+    def providers(self):
+        return list(self.meta["providers"])
+
+    def _column(self, name):
+        if name not in self._columns:
+            self._columns[name] = _Column(self._column_file(name), "Q")
+        return self._columns[name]
+
+    def value(self, name, i):
+        # The [IPv4, IPv6] value for a provider for one row, or None if it's missing
+        view = self._column(name).view
+        v4 = view[i * 3]
+        if v4 == MISSING:
+            return None
+        return [v4, (view[i * 3 + 1] << 64) | view[i * 3 + 2]]
+
+    def date(self, i):
+        return from_timestamp(self._dates.view[i])
+
+    def row(self, i):
+        # One row, in the same format as a line from summary.jsonl
+        ret = {"_": self.date(i)}
+        for name in self.meta["providers"]:
+            value = self.value(name, i)
+            if value is not None:
+                ret[name] = value
+        return ret
+
+    def rows(self, start=0, end=None):
+        # All of the rows from start up to, but not including end
+        if end is None:
+            end = len(self)
+        return [self.row(i) for i in range(max(0, start), min(end, len(self)))]
+
+    def last(self, count):
+        # The last count rows
+        return self.rows(len(self) - count)
+
+    def index_between(self, start, end):
+        # The range of row indexes with dates from start to end, inclusive
+        return bisect_left(self._dates.view, to_timestamp(start)), bisect_right(self._dates.view, to_timestamp(end))
+
+    def between(self, start, end):
+        # All of the rows with dates from start to end, inclusive
+        return self.rows(*self.index_between(start, end))
+
+    def series(self, name, start=0, end=None):
+        # One provider's history, as a list of (date, [IPv4, IPv6]) pairs, the
+        # value is None for any rows the provider is missing
+        if end is None:
+            end = len(self)
+        if name not in self.meta["providers"]:
+            return [(self.date(i), None) for i in range(max(0, start), min(end, len(self)))]
+        return [(self.date(i), self.value(name, i)) for i in range(max(0, start), min(end, len(self)))]
+
+def main():
+    store = SummaryStore()
+    if len(sys.argv) == 2 and sys.argv[1] == "sync":
+        print(f"Store has {len(store)} rows for {len(store.providers)} providers")
+    elif len(sys.argv) == 3 and sys.argv[1] == "last":
+        for row in store.last(int(sys.argv[2])):
+            print(json.dumps(row, separators=(',', ':'), sort_keys=True))
+    elif len(sys.argv) == 4 and sys.argv[1] == "between":
+        for row in store.between(sys.argv[2], sys.argv[3]):
+            print(json.dumps(row, separators=(',', ':'), sort_keys=True))
+    elif len(sys.argv) == 3 and sys.argv[1] == "series":
+        for date, value in store.series(sys.argv[2]):
+            print(f"{date},{'' if value is None else value[0]},{'' if value is None else value[1]}")
+    else:
+        print("Usage:")
+        print("  sync                = Bring the store up to date with summary.jsonl")
+        print("  last <n>            = Show the last <n> rows")
+        print("  between <a> <b>     = Show rows between two dates, in 'YYYY-MM-DD HH:MM:SS' format")
+        print("  series <provider>   = Show the history for one provider")
+
+if __name__ == "__main__":
+    main()
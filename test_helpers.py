@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 
 from importlib.util import spec_from_file_location, module_from_spec
-from netaddr import IPSet, IPNetwork
-import gzip
-import json
 import os
 import sys
 
+# Let the helpers find the code they share
+sys.path.insert(0, os.path.join(os.path.split(os.path.abspath(__file__))[0], "helpers"))
+from common.rangeset import RangeSet
+from common.streaming import archive_raw
+
 def approximate_count(val):
     val = val.size
     for scale in range(36, 0, -3):
@@ -16,9 +18,9 @@ def approximate_count(val):
 
 def get_main_ranges():
     # Stolen from https://github.com/seligman/aws-ip-ranges
-    internet = IPSet([IPNetwork("0.0.0.0/0")])
+    internet = RangeSet(["0.0.0.0/0"])
 
-    private = IPSet([IPNetwork(x) for x in [
+    private = RangeSet([
         "0.0.0.0/8",       # RFC 1700 broadcast addresses
         "10.0.0.0/8",      # RFC 1918 Private address space (aka, your work LAN)
         "100.64.0.0/10",   # IANA Carrier Grade NAT (not your home NAT, no sirree)
@@ -35,7 +37,7 @@ def get_main_ranges():
         "203.0.113.0/24",  # RFC 5737 TEST-NET-3 for internal use
         "224.0.0.0/4",     # RFC 5771 Multicast Addresses
         "240.0.0.0/4",     # RFC 6890 Reserved for future use (or if the RFC team needs to make a few bucks)
-    ]])
+    ])
 
     return internet, private
 
@@ -59,10 +61,10 @@ def main():
                 ips = module_from_spec(spec)
                 spec.loader.exec_module(ips)
                 data = ips.get_and_parse()
-                if data['raw_format'] == "json":
-                    data['raw_data'] = json.dumps(data['raw_data'], separators=(',', ':'))
-                data['raw_data'] = gzip.compress(data['raw_data'].encode("utf-8"))
-                print(f"IPv4: {approximate_count(data['v4']):<9} ({data['v4'].size / public_ips * 100:6.4f}%) / IPv6: {approximate_count(data['v6']):<9} / Raw: {len(data['raw_data']):7d}", flush=True)
+                data['raw_data'] = archive_raw(data['raw_data'], data['raw_format'])
+                data['raw_data'].discard()
+                raw_size = data['raw_data'].compressed_size
+                print(f"IPv4: {approximate_count(data['v4']):<9} ({data['v4'].size / public_ips * 100:6.4f}%) / IPv6: {approximate_count(data['v6']):<9} / Raw: {raw_size:7d}", flush=True)
                 for other, other_v4 in known.items():
                     overlap = other_v4 & data['v4']
                     if overlap.size > 0 and other not in data['allowed_overlap']:
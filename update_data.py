@@ -1,18 +1,30 @@
 #!/usr/bin/env python3
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
+from glob import glob
+from hashlib import sha256
+from sparkline import SVG_VERSION, draw_history_svg
+from summary_store import SummaryStore
 import json
-import matplotlib.pyplot as plt
 import os
 import subprocess
 import sys
+import threading
 if sys.version_info >= (3, 11): from datetime import UTC
 else: import datetime as datetime_fix; UTC=datetime_fix.timezone.utc
 
+# Record timings the same way as the helpers do
+sys.path.insert(0, os.path.join(os.path.split(os.path.abspath(__file__))[0], "helpers"))
+from common import metrics, profiling
+
 _started = datetime.now(UTC).replace(tzinfo=None)
+_log_lock = threading.Lock()
 def log_step(value):
-    # Simple helper to show how long everything takes
-    print(f"{(datetime.now(UTC).replace(tzinfo=None) - _started).total_seconds():8.4f}: {value}", flush=True)
+    # Simple helper to show how long everything takes, stages can log
+    # at the same time, so only one line is written at once
+    with _log_lock:
+        print(f"{(datetime.now(UTC).replace(tzinfo=None) - _started).total_seconds():8.4f}: {value}", flush=True)
 
 def run(cmd):
     # Run commands
@@ -29,63 +41,210 @@ def fast_parse_date(text):
         second=int(text[17:19] or 0)
     )
 
-def main():
-    show_help = False
-    chart_only = False
-    draw_hilbert = True
-    run_git_commands = True
-    force_draw = set()
+# The style used for all charts
+CHART_STYLE = "dark_background"
+# Change this if the way charts are drawn changes, to force them all to be redrawn
+CHART_VERSION = 1
+# The inputs used to draw each chart last time
+CHART_CACHE = os.path.join("images", "chart_inputs.json")
 
-    args = sys.argv[1:]
-    while len(args) > 0:
-        if args[0].lower() == "charts":
-            args.pop(0)
-            chart_only = True
-            run_git_commands = False
-        elif args[0].lower() in {"no_hilbert", "nohilbert"}:
-            args.pop(0)
-            draw_hilbert = False
-            run_git_commands = False
-        elif args[0].lower() in {"skip_git", "skipgit"}:
-            args.pop(0)
-            run_git_commands = False
-        elif args[0].lower() == "force" and len(args) > 1:
-            args.pop(0)
-            force_draw.add(args.pop(0))
+def draw_main_chart(dest, values, labels, min_y, max_y):
+    # Draw the bar chart of the current size of each provider, matplotlib is
+    # slow to load, so it's only loaded when a chart needs it
+    import matplotlib.pyplot as plt
+    with plt.style.context(CHART_STYLE):
+        fig = plt.figure(figsize=(8, 5))
+        try:
+            plt.grid(True, which='major', axis='y', zorder=1, color=(.5, .5, .5))
+            plt.grid(True, which='minor', axis='y', zorder=1, color=(.5, .5, .5))
+            plt.bar(range(len(values)), values, zorder=2)
+            plt.xticks(range(len(values)), labels)
+            plt.yticks(plt.yticks()[0], [f"{int(x/1000000):d}m" for x in plt.yticks()[0]])
+            plt.yscale('log')
+            plt.ylim((min_y, max_y))
+            plt.tight_layout()
+            plt.savefig(dest, dpi=100)
+        finally:
+            # Always close the figure, otherwise each one stays in memory
+            plt.close(fig)
+
+def draw_history_chart(dest, xaxis, history, min_y, max_y, label, epoch):
+    # Draw the percent change over time for one provider
+    import matplotlib.pyplot as plt
+    with plt.style.context(CHART_STYLE):
+        fig = plt.figure(figsize=(8, 2))
+        try:
+            plt.plot(xaxis, history, linewidth=3.0)
+            plt.ylim((min_y, max_y))
+            plt.xlim((min(xaxis), max(xaxis)))
+            plt.xticks(plt.xticks()[0], [f"{(epoch + timedelta(days=x)).strftime('%m-%d')}" for x in plt.xticks()[0]])
+            plt.yticks(plt.yticks()[0], [f"{int(x):d}%" for x in plt.yticks()[0]])
+            plt.ylabel(label)
+            plt.tight_layout()
+            plt.savefig(dest, dpi=100)
+        finally:
+            plt.close(fig)
+
+def chart_backend_version(func):
+    # The version of whatever draws a chart, without loading matplotlib
+    if func is draw_history_svg:
+        return f"svg-{SVG_VERSION}"
+    from importlib import metadata
+    return metadata.version("matplotlib")
+
+def chart_fingerprint(func, args):
+    # A hash of everything that goes into drawing a chart
+    data = [CHART_VERSION, CHART_STYLE, chart_backend_version(func), func.__name__, args]
+    return sha256(json.dumps(data, default=str).encode("utf-8")).hexdigest()
+
+def draw_chart(func, args):
+    # Draw one chart, recording how long it took
+    with metrics.span("chart", chart=os.path.basename(args[0])), profiling.profile("chart_" + os.path.basename(args[0])):
+        func(*args)
+
+def render_charts(jobs, workers, redraw=False):
+    # Run each chart job, a description, function, and arguments, in a pool of
+    # processes, since matplotlib can't draw more than one chart at a time in
+    # a single process.  Any chart that's already drawn with the same inputs
+    # is skipped.  The first argument of each job is the image filename.
+    cache = {}
+    if os.path.isfile(CHART_CACHE) and not redraw:
+        with open(CHART_CACHE, "rt") as f:
+            cache = json.load(f)
+
+    todo = []
+    for desc, func, args in jobs:
+        fingerprint = chart_fingerprint(func, args)
+        if cache.get(args[0]) == fingerprint and os.path.isfile(args[0]):
+            log_step(desc + ", no change")
         else:
-            show_help = True
-            break
-    
-    if show_help:
-        print("Usage:")
-        print("  charts     - Only draw charts, don't update date or check in changes")
-        print("  no_hilbert - Don't update the Hilbert Curve map")
-        print("  skip_git   - Skip running all git commands")
-        print("  force <x>  - Force helper <x> to be included, even if previously disabled")
-        exit(1)
+            cache[args[0]] = fingerprint
+            todo.append((desc, func, args))
+    jobs = todo
 
-    log_step("Starting work")
+    if workers <= 1 or len(jobs) <= 1:
+        for desc, func, args in jobs:
+            draw_chart(func, args)
+            log_step(desc)
+    else:
+        # Only load multiprocessing when there's something to draw.  The
+        # workers are started fresh rather than forked, since other stages'
+        # threads could be holding the log or metrics locks at the time
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [(desc, pool.submit(draw_chart, func, args)) for desc, func, args in jobs]
+            for desc, future in futures:
+                future.result()
+                log_step(desc)
 
-    if not chart_only:
-        # Main worker to update all data
-        run(["python3", "get_all.py"])
+    # Forget about any charts that no longer exist
+    cache = {x: y for x, y in cache.items() if os.path.isfile(x)}
+    with open(CHART_CACHE, "wt", newline="") as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+        f.write("\n")
 
-    # Draw the images
-    if not os.path.isdir("images"):
-        os.mkdir("images")
+# The inputs used by each stage last time it ran
+STAGE_CACHE = os.path.join("images", "stage_inputs.json")
+
+def save_stage_cache(cache):
+    # Called with the cache lock held, so the cache is saved as each stage
+    # finishes, and it's already on disk when the git stage checks it in
+    with open(STAGE_CACHE + ".tmp", "wt", newline="") as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+        f.write("\n")
+    os.replace(STAGE_CACHE + ".tmp", STAGE_CACHE)
+
+def stage_fingerprint(stage):
+    # A hash of the files a stage reads, or None if it should always run.  The
+    # inputs are glob patterns, looked at when the stage is ready to run, so
+    # they see the files written by the stages before it
+    if stage.get("inputs") is None:
+        return None
+    data = [stage["name"], stage.get("key")]
+    for pattern in stage["inputs"]:
+        for fn in sorted(glob(pattern)):
+            with open(fn, "rb") as f:
+                data.append([fn, sha256(f.read()).hexdigest()])
+    return sha256(json.dumps(data, default=str).encode("utf-8")).hexdigest()
+
+def run_stage(stage, cache, cache_lock):
+    # Run one stage, unless the files it reads and writes haven't changed
+    # since it last ran, returns how long it took
+    started = datetime.now(UTC)
+    fingerprint = stage_fingerprint(stage)
+    with cache_lock:
+        unchanged = fingerprint is not None and cache.get(stage["name"]) == fingerprint
+    if unchanged and not stage.get("force") and all(os.path.isfile(x) for x in stage.get("outputs", [])):
+        log_step(f"Stage {stage['name']}, no change")
+        metrics.count("stage.skipped", stage=stage["name"])
+        return None
+    log_step(f"Stage {stage['name']}, starting")
+    with metrics.span("stage", stage=stage["name"]), profiling.profile("stage_" + stage["name"]):
+        stage["run"]()
+    if fingerprint is not None:
+        with cache_lock:
+            cache[stage["name"]] = fingerprint
+            save_stage_cache(cache)
+    secs = (datetime.now(UTC) - started).total_seconds()
+    log_step(f"Stage {stage['name']}, done in {secs:.4f} seconds")
+    return secs
+
+def run_stages(stages):
+    # Run a list of stages, each one a dictionary:
+    #   name     - The name of the stage
+    #   run      - The function to call to do the work
+    #   after    - The stages that need to finish before this one starts
+    #   inputs   - Glob patterns for the files it reads, if they haven't changed
+    #              and the outputs exist, the stage is skipped.  Leave it out to
+    #              always run the stage
+    #   key      - Anything else that changes what the stage does
+    #   outputs  - The files the stage makes
+    #   force    - Run the stage even if nothing changed
+    # Stages that don't depend on each other are run at the same time
+    cache = {}
+    if os.path.isfile(STAGE_CACHE):
+        with open(STAGE_CACHE, "rt") as f:
+            cache = json.load(f)
+    cache_lock = threading.Lock()
+
+    names = {x["name"] for x in stages}
+    pending = {x["name"]: x for x in stages}
+    done = set()
+    timings = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=len(stages) or 1) as pool:
+        while len(pending) > 0 or len(running) > 0:
+            for name, stage in list(pending.items()):
+                # Stages that aren't being run this time don't hold anything up
+                if all(x in done or x not in names for x in stage.get("after", [])):
+                    del pending[name]
+                    running[pool.submit(run_stage, stage, cache, cache_lock)] = name
+            if len(running) == 0:
+                raise Exception(f"Stages can never run: {', '.join(sorted(pending))}")
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                timings[name] = future.result()
+                done.add(name)
+
+    log_step("Stage timings:")
+    for stage in stages:
+        if stage["name"] in timings:
+            secs = timings[stage["name"]]
+            log_step(f"  {stage['name']:<10} {'skipped' if secs is None else f'{secs:.4f} seconds'}")
 
-    data = []
-    with open(os.path.join("data", "summary.jsonl"), "rt") as f:
-        for row in f:
-            data.append(row)
-            if len(data) > 365:
-                data.pop(0)
+def load_history(force_draw):
+    # Load the last year of data, along with the enabled providers, sorted by
+    # their pretty name, and the pretty names themselves
+    store = SummaryStore()
+    data = store.last(365)
+    store.close()
 
     # Find all off the different providers being used
     providers = set()
-    for i in range(len(data)):
-        data[i] = json.loads(data[i])
-        providers |= set(data[i])
+    for row in data:
+        providers |= set(row)
     if "_" in providers:
         providers.remove("_")
     
@@ -104,6 +263,14 @@ def main():
     providers = sorted(providers, key=lambda x: pretties.get(x, [x])[0].lower())
     # Limit the providers to only the enabled ones
     providers = [x for x in providers if x in enabled]
+    return data, providers, pretties
+
+def draw_charts(force_draw, history_format, workers, redraw):
+    # Draw the images
+    if not os.path.isdir("images"):
+        os.mkdir("images")
+
+    data, providers, pretties = load_history(force_draw)
 
     # Run through and find the y limits of all the providers
     # so we can use one y limit for all charts
@@ -131,100 +298,199 @@ def main():
     pretty_order = providers[:]
     pretty_order.sort(key=lambda x:data[-1].get(x, [0])[0], reverse=True)
 
-    md = ""
-    with plt.style.context("dark_background"):
-        log_step("Main chart")
-        plt.figure(figsize=(8, 5))
-        plt.grid(True, which='major', axis='y', zorder=1, color=(.5, .5, .5))
-        plt.grid(True, which='minor', axis='y', zorder=1, color=(.5, .5, .5))
-        plt.bar(range(len(providers)), [data[-1].get(x, [0])[0] for x in pretty_order], zorder=2)
-        plt.xticks(range(len(providers)), [("\n" if i % 2 == 1 else "") + pretties.get(x, [x])[0] for i, x in enumerate(pretty_order)])
-        plt.yticks(plt.yticks()[0], [f"{int(x/1000000):d}m" for x in plt.yticks()[0]])
-        plt.yscale('log')
-        plt.ylim((min_y, max_y))
-        plt.tight_layout()
-        plt.savefig(os.path.join("images", "main.png"), dpi=100)
-
-        # Pull out the dates, use a number so matplotlib can align things
-        epoch = datetime(2020, 1, 1)
-        xaxis = [(fast_parse_date(x['_']) - epoch).total_seconds() / 86400.0 for x in data]
-
-        min_y, max_y = 0, 0
-        percent_change = {}
-        # Calculate the percent change for all of the providers
-        for cur in providers:
-            history = [x.get(cur, [None])[0] for x in data]
-   
-            # Fill in any gaps to prevent drops to zero when no data is found
-            last_value = 0
-            for i, x in enumerate(history):
-                if x is None:
-                    history[i] = last_value
-                else:
-                    last_value = x
-
-            temp = []
-            last_value = history[0]
-            for cur_value in history:
-                if last_value > 0:
-                    temp.append(((cur_value - last_value) / last_value) * 100)
-                else:
-                    temp.append(0)
-                last_value = cur_value
-            percent_change[cur] = temp
-            temp = [x for x in temp if abs(x) <= 5]
-            if len(temp) > 0:
-                min_y = min(min_y, min(temp))
-                max_y = max(max_y, max(temp))
-
-        if (max_y - min_y) > 0.05:
-            buffer = (max_y - min_y) * 0.05
-        else:
-            buffer = 0.025
+    # Each chart is drawn on its own, so they can be drawn at the same time
+    jobs = []
+    jobs.append(("Main chart", draw_main_chart, (
+        os.path.join("images", "main.png"),
+        [data[-1].get(x, [0])[0] for x in pretty_order],
+        [("\n" if i % 2 == 1 else "") + pretties.get(x, [x])[0] for i, x in enumerate(pretty_order)],
+        min_y, max_y,
+    )))
 
-        min_y -= buffer
-        max_y += buffer
+    # Pull out the dates, use a number so matplotlib can align things
+    epoch = datetime(2020, 1, 1)
+    xaxis = [(fast_parse_date(x['_']) - epoch).total_seconds() / 86400.0 for x in data]
 
-        for cur in providers:
-            log_step(f"Chart for {cur}")
-            md += f"![{cur}](images/history_{cur}.png)<br>\n"
-            plt.clf()
-            plt.figure(figsize=(8, 2))
-            history = percent_change[cur]
+    min_y, max_y = 0, 0
+    percent_change = {}
+    # Calculate the percent change for all of the providers
+    for cur in providers:
+        history = [x.get(cur, [None])[0] for x in data]
 
-            plt.plot(xaxis, history, linewidth=3.0)
-            plt.ylim((min_y, max_y))
-            plt.xlim((min(xaxis), max(xaxis)))
-            plt.xticks(plt.xticks()[0], [f"{(epoch + timedelta(days=x)).strftime('%m-%d')}" for x in plt.xticks()[0]])
-            plt.yticks(plt.yticks()[0], [f"{int(x):d}%" for x in plt.yticks()[0]])
-            plt.ylabel(pretties.get(cur, [cur])[0])
-            plt.tight_layout()
-            plt.savefig(os.path.join("images", f"history_{cur}.png"), dpi=100)
+        # Fill in any gaps to prevent drops to zero when no data is found
+        last_value = 0
+        for i, x in enumerate(history):
+            if x is None:
+                history[i] = last_value
+            else:
+                last_value = x
 
-    if draw_hilbert:
-        log_step("Draw a map of the big IP ranges")
-        subprocess.check_call(["python3", "draw_map.py", os.path.join("images", "map.png")])
+        temp = []
+        last_value = history[0]
+        for cur_value in history:
+            if last_value > 0:
+                temp.append(((cur_value - last_value) / last_value) * 100)
+            else:
+                temp.append(0)
+            last_value = cur_value
+        percent_change[cur] = temp
+        temp = [x for x in temp if abs(x) <= 5]
+        if len(temp) > 0:
+            min_y = min(min_y, min(temp))
+            max_y = max(max_y, max(temp))
+
+    if (max_y - min_y) > 0.05:
+        buffer = (max_y - min_y) * 0.05
+    else:
+        buffer = 0.025
+
+    min_y -= buffer
+    max_y += buffer
+
+    draw_history = draw_history_svg if history_format == "svg" else draw_history_chart
+    for cur in providers:
+        jobs.append((f"Chart for {cur}", draw_history, (
+            os.path.join("images", f"history_{cur}.{history_format}"),
+            xaxis, percent_change[cur], min_y, max_y, pretties.get(cur, [cur])[0], epoch,
+        )))
+        # Remove the chart in the other format, nothing points to it now
+        other = os.path.join("images", f"history_{cur}.{'png' if history_format == 'svg' else 'svg'}")
+        if os.path.isfile(other):
+            os.unlink(other)
+
+    render_charts(jobs, workers, redraw)
+
+def write_readme(force_draw, history_format):
+    # Update the README, if anything in it changed
+    _, providers, _ = load_history(force_draw)
+    md = ""
+    for cur in providers:
+        md += f"![{cur}](images/history_{cur}.{history_format})<br>\n"
 
-    # Update the README
-    log_step("Create README from template")
     with open("README.template.md", "rt") as f_src:
+        data = f_src.read()
+        data = data.replace("[[history]]", md)
+    old_data = None
+    if os.path.isfile("README.md"):
+        with open("README.md", "rt", newline="") as f:
+            old_data = f.read()
+    if old_data != data:
         with open("README.md", "wt", newline="") as f_dest:
-            data = f_src.read()
-            data = data.replace("[[history]]", md)
             f_dest.write(data)
+    else:
+        log_step("README has no changes")
 
-    if run_git_commands:
-        # Check in any changes
-        run(["git", "add", "."])
-        log_step("Look for changes")
-        changes = subprocess.check_output(["git", "status", "--porcelain"]).decode("utf-8")
-        changes = len([x for x in changes.split("\n") if len(changes.strip()) > 0])
-        if changes > 0:
-            # Only bother with a commit if something changes
-            run(["git", "commit", "-a", "-m", "Update data files"])
-            run(["git", "push"])
+def commit_changes():
+    # Check in any changes, including what each stage saw this time, so the
+    # next run from a fresh checkout can skip the stages that have no changes
+    run(["git", "add", "."])
+    run(["git", "add"] + [x for x in [STAGE_CACHE, CHART_CACHE] if os.path.isfile(x)])
+    log_step("Look for changes")
+    changes = subprocess.check_output(["git", "status", "--porcelain"]).decode("utf-8")
+    changes = len([x for x in changes.split("\n") if len(changes.strip()) > 0])
+    if changes > 0:
+        # Only bother with a commit if something changes
+        run(["git", "commit", "-a", "-m", "Update data files"])
+        run(["git", "push"])
+    else:
+        log_step("No changes")
+
+def main():
+    show_help = False
+    chart_only = False
+    draw_hilbert = True
+    run_git_commands = True
+    force_draw = set()
+    workers = os.cpu_count() or 1
+    redraw = False
+    history_format = "png"
+
+    args = sys.argv[1:]
+    while len(args) > 0:
+        if args[0].lower() == "charts":
+            args.pop(0)
+            chart_only = True
+            run_git_commands = False
+        elif args[0].lower() in {"no_hilbert", "nohilbert"}:
+            args.pop(0)
+            draw_hilbert = False
+            run_git_commands = False
+        elif args[0].lower() in {"skip_git", "skipgit"}:
+            args.pop(0)
+            run_git_commands = False
+        elif args[0].lower() == "force" and len(args) > 1:
+            args.pop(0)
+            force_draw.add(args.pop(0))
+        elif args[0].lower() == "redraw":
+            args.pop(0)
+            redraw = True
+        elif args[0].lower() == "profile":
+            # This is passed on to get_all and draw_map as well
+            args.pop(0)
+            profiling.enable()
+        elif args[0].lower() == "svg":
+            args.pop(0)
+            history_format = "svg"
+        elif args[0].lower() == "workers" and len(args) > 1:
+            args.pop(0)
+            workers = int(args.pop(0))
         else:
-            log_step("No changes")
+            show_help = True
+            break
+    
+    if show_help:
+        print("Usage:")
+        print("  charts     - Only draw charts, don't update date or check in changes")
+        print("  no_hilbert - Don't update the Hilbert Curve map")
+        print("  skip_git   - Skip running all git commands")
+        print("  force <x>  - Force helper <x> to be included, even if previously disabled")
+        print("  workers <x> - Draw up to <x> charts at once, defaults to the number of CPUs")
+        print("  redraw     - Redraw all charts, even if nothing changed")
+        print("  svg        - Draw the history charts as SVG files, without matplotlib")
+        print("  profile    - Profile each stage, see helpers/common/profiling.py")
+        exit(1)
+
+    log_step("Starting work")
+
+    # The charts, map, and README only depend on the data, not each other
+    history_inputs = [os.path.join("data", "summary.jsonl"), os.path.join("data", "names.json")]
+    history_key = [sorted(force_draw), history_format]
+    stages = []
+    if not chart_only:
+        # Main worker to update all data
+        stages.append({"name": "get_all", "run": lambda: run(["python3", "get_all.py"])})
+    # Bring the summary store up to date once, before the charts and README
+    # both read from it at the same time
+    stages.append({"name": "store", "run": lambda: SummaryStore().close(), "after": ["get_all"]})
+    stages.append({
+        "name": "charts",
+        "run": lambda: draw_charts(force_draw, history_format, workers, redraw),
+        "after": ["store"],
+        # Always run, each chart checks its own inputs and that its image is
+        # still there, and only the changed or missing ones are drawn
+    })
+    if draw_hilbert:
+        stages.append({
+            "name": "map",
+            "run": lambda: run(["python3", "draw_map.py", os.path.join("images", "map.png")]),
+            "after": ["get_all"],
+            "inputs": [os.path.join("data", f"data_{x}.json.*") for x in ["aws", "azure", "google"]] + ["draw_map.py"],
+            "outputs": [os.path.join("images", "map.png")],
+            "force": redraw,
+        })
+    stages.append({
+        "name": "readme",
+        "run": lambda: write_readme(force_draw, history_format),
+        "after": ["store"],
+        "inputs": history_inputs + ["README.template.md"],
+        "key": history_key,
+        "outputs": ["README.md"],
+    })
+    if run_git_commands:
+        # This runs last, after every other stage has saved its inputs
+        stages.append({"name": "git", "run": commit_changes, "after": [x["name"] for x in stages]})
+
+    run_stages(stages)
 
     log_step("All done")
 